@@ -16,6 +16,7 @@
 
 
 import errno
+from itertools import count
 import os
 import stat
 import sys
@@ -28,11 +29,14 @@ fuse.fuse_python_api = (0, 2)
 fuse.feature_assert(26)
 
 
+_inodes = count(1)
+
+
 class Direntry(fuse.Direntry):
 
     def __init__(self, name, **kwargs):
         self.st_dev = 0
-        self.st_ino = 0
+        self.st_ino = _inodes.next()
         self.st_mode = kwargs.get('type', 0)
         self.st_nlink = 0
         self.st_uid = os.getuid()
@@ -45,6 +49,7 @@ class Direntry(fuse.Direntry):
         self.st_atime = _time
         self.st_mtime = _time
         self.st_ctime = _time
+        kwargs.setdefault('ino', self.st_ino)
         fuse.Direntry.__init__(self, name, **kwargs)
 
     def getattr(self):
@@ -94,6 +99,9 @@ class File(Direntry):
     def read(self, size, offset):
         return self.content()[offset:offset + size]
 
+    def truncate(self, size):
+        raise IOError, (errno.EPERM, None)
+
 
 class Directory(Direntry):
 
@@ -102,10 +110,22 @@ class Directory(Direntry):
             kwargs['type'] = stat.S_IFDIR
         Direntry.__init__(self, name, **kwargs)
         self.st_mode = self.type | mode
+        self._dentries = None
+        self._dentries_rev = None
 
     def content(self):
         pass
 
+    def rev(self):
+        return None
+
+    def lookup(self, name):
+        rev = self.rev()
+        if self._dentries is None or self._dentries_rev != rev:
+            self._dentries = dict((de.name, de) for de in self.content())
+            self._dentries_rev = rev
+        return self._dentries.get(name)
+
     def getattr(self):
         self.st_nlink = 2
         for direntry in self.content():
@@ -144,11 +164,10 @@ class Filesystem(fuse.Fuse):
         else:
             direntry = self.root
             for name in path.split(os.sep)[1:]:
-                for de in direntry.content():
-                    if de.name == name:
-                        direntry = de
-                        break
-                else:
+                if not isinstance(direntry, Directory):
+                    raise IOError, (errno.ENOTDIR, None)
+                direntry = direntry.lookup(name)
+                if direntry is None:
                     raise IOError, (errno.ENOENT, None)
             return direntry
 
@@ -181,6 +200,9 @@ class Filesystem(fuse.Fuse):
     def open(self, path, flags):
         return self.get(path).open(flags, context=self.GetContext())
 
+    def truncate(self, path, size):
+        self.get(path).truncate(size)
+
     def unlink(self, path):
         self.get(path).unlink()
 
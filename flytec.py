@@ -17,198 +17,1017 @@
 
 from __future__ import with_statement
 
+from bisect import bisect_left
 from collections import defaultdict
 import datetime
-from dircache import listdir
 from gzip import GzipFile
+import logging
+from operator import attrgetter
 import os
 import os.path
 import re
 import sys
 from tempfile import mkstemp
+import threading
+import time
+import zlib
 
-from flytecdevice import FlytecDevice
+from flytecdevice import Error, FlytecDevice, NMEAError, UTC
+from flytecdevice import PBRTL_RE, pbrtl_tracklog
+from flytecdevice import pbrwpr_name, pbrwpr_waypoint
+from flytecdevice import Route, Routepoint, Tracklog, Waypoint
+from gpx import FragmentCache
+import igc
+from lrucache import LRUCache
+from packstore import PackStore, deflate
+from stats import Stats
 
 
 TRACKLOG_ID_RE = re.compile(r'\A(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)Z\Z')
 
+IGC_HEADER_SIZE = 1024
+IGC_B_RECORD_SIZE = 37
+
+DEFAULT_CACHE_BUDGET = 64 << 20
+
+MEMORY_SIZE = 352
+
+WAYPOINT_CAPACITY = 200
+
+SNAPSHOT_VERSION = 2
+SNAPSHOT_RETRY_DELAY = 1.0
+SNAPSHOT_MAX_RETRY_DELAY = 60.0
+
+
+def atomic_write(path, write):
+    dirname = os.path.dirname(path)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    fd, tmppath = mkstemp('', '', dirname)
+    try:
+        with os.fdopen(fd, 'w') as file:
+            write(file)
+        os.rename(tmppath, path)
+    except:
+        os.remove(tmppath)
+        raise
+
+
+class TracklogDownload(threading.Thread):
+
+    def __init__(self, flytec, tracklog):
+        threading.Thread.__init__(self, name='TracklogDownload')
+        self.setDaemon(True)
+        self.flytec = flytec
+        self.tracklog = tracklog
+        self.background = getattr(flytec.device.local, 'background', False)
+        self.buffer = bytearray()
+        self.condition = threading.Condition()
+        self.done = False
+        self.error = None
+
+    def run(self):
+        self.flytec.device.local.background = self.background
+        try:
+            try:
+                for line in self.flytec.device.ipbrtr(self.tracklog):
+                    with self.condition:
+                        self.buffer.extend(line)
+                        self.condition.notifyAll()
+                self.flytec.tracklog_store(self.tracklog, str(self.buffer))
+            except Exception, e:
+                self.error = e
+        finally:
+            with self.flytec.lock('downloads'):
+                del self.flytec._downloads[self.tracklog.id]
+            with self.condition:
+                self.done = True
+                self.condition.notifyAll()
+
+    def read(self, size, offset):
+        with self.condition:
+            while len(self.buffer) < offset + size and not self.done:
+                self.condition.wait()
+            if not self.error is None:
+                raise self.error
+            return str(self.buffer[offset:offset + size])
+
+    def foreground(self):
+        with self.condition:
+            if not self.background or self.done:
+                return
+            self.background = False
+        self.flytec.device.promote(self, 'PBRTR')
+
+    def wait(self):
+        with self.condition:
+            while not self.done:
+                self.condition.wait()
+            if not self.error is None:
+                raise self.error
+
+
+class TracklogPrefetcher(threading.Thread):
+
+    def __init__(self, flytec):
+        threading.Thread.__init__(self, name='TracklogPrefetcher')
+        self.setDaemon(True)
+        self.flytec = flytec
+        self.state = 'idle'
+        self.current = None
+        self.done = 0
+        self.errors = 0
+        self.error = None
+        self.total = 0
+
+    def run(self):
+        self.flytec.device.local.background = True
+        self.update('listing')
+        try:
+            tracklogs = sorted(self.flytec.tracklogs(),
+                               key=attrgetter('dt'),
+                               reverse=True)
+            tracklogs = [tracklog for tracklog in tracklogs
+                         if not self.flytec.tracklog_cached(tracklog)]
+        except Exception, e:
+            self.fail('listing', e)
+            self.update('error')
+            return
+        self.total = len(tracklogs)
+        for tracklog in tracklogs:
+            self.update('downloading', tracklog)
+            try:
+                self.flytec.tracklog_content(tracklog)
+                self.done += 1
+            except Exception, e:
+                self.fail('downloading', e)
+        self.update('done')
+
+    def fail(self, state, e):
+        self.errors += 1
+        self.error = '%s: %s' % (state, e.__class__.__name__)
+        if str(e):
+            self.error += ': %s' % e
+        self.flytec.stats.count('flytec_prefetch_errors_total',
+                                (('state', state),))
+
+    def status(self):
+        lines = ['state: %s' % self.state,
+                 'done: %d' % self.done,
+                 'errors: %d' % self.errors,
+                 'total: %d' % self.total]
+        if not self.current is None:
+            lines.append('current: %s' % self.current.id)
+        if not self.error is None:
+            lines.append('error: %s' % self.error)
+        return ''.join('%s\n' % line for line in lines)
+
+    def update(self, state, current=None):
+        self.state = state
+        self.current = current
+        self.flytec.revs['prefetch'] += 1
+
 
 class Flytec(object):
 
-    def __init__(self, file_or_path, cachebasedir=None):
-        self.device = FlytecDevice(file_or_path)
-        self._memory = [None] * 352
+    def __init__(self, file_or_path, cachebasedir=None, prefetch=False,
+                 cache_budget=DEFAULT_CACHE_BUDGET):
+        self.logger = logging.getLogger(__name__)
+        self.stats = Stats()
+        self.device = FlytecDevice(file_or_path, self.stats)
+        self.contents = LRUCache(cache_budget)
+        self.fragments = FragmentCache()
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+        self._memory = None
         self._routes = None
+        self._routes_index = {}
         self._routes_rev = None
         self._snp = self.device.pbrsnp()
+        self._snapshot_loaded = False
+        self._snapshot_revalidator = None
+        self._snapshot_retry_delay = SNAPSHOT_RETRY_DELAY
+        self._snapshot_retry_time = 0
+        self._stale = set()
+        self._dates = None
+        self._downloads = {}
+        self._pack = None
+        self._renames = None
         self._tracklogs = None
+        self._tracklogs_index = {}
+        self._views = {}
         self._waypoints = None
+        self._waypoints_index = {}
         self._waypoints_rev = None
+        self._waypoint_types = None
         self.revs = defaultdict(int)
         if cachebasedir is None:
             cachebasedir = os.path.expanduser('~/.flytecfs/cache')
         self.cachedir = os.path.join(cachebasedir,
                                      self._snp.instrument,
                                      self._snp.serial_number)
+        self.prefetcher = TracklogPrefetcher(self) if prefetch else None
 
     def get_cache_path(self, *args):
         return os.path.join(self.cachedir, *args)
 
+    def lock(self, key):
+        with self.locks_lock:
+            if not key in self.locks:
+                self.locks[key] = threading.RLock()
+            return self.locks[key]
+
     def memory(self, sl=slice(None, None)):
+        with self.lock('memory'):
+            if self._memory is None:
+                self._memory_load()
+            return self._memory_read(sl)
+
+    def memory_cache_path(self):
+        return self.get_cache_path('memory', self.snp().software_version)
+
+    def _memory_load(self):
+        self._memory = [None] * MEMORY_SIZE
+        try:
+            with open(self.memory_cache_path()) as file:
+                data = file.read()
+        except IOError:
+            return
+        if len(data) == MEMORY_SIZE:
+            self._memory = map(ord, data)
+            thread = threading.Thread(target=self._memory_revalidate,
+                                      name='MemoryRevalidator')
+            thread.setDaemon(True)
+            thread.start()
+
+    def _memory_revalidate(self):
+        self.device.local.background = True
+        try:
+            memory = self.device.pbrmemr(slice(0, MEMORY_SIZE))
+        except (Error, IOError, NMEAError, OSError), e:
+            self.logger.warning('memory revalidation failed: %r', e)
+            return
+        with self.lock('memory'):
+            if memory != self._memory:
+                self._memory = memory
+                self._memory_save()
+                self.revs['memory'] += 1
+
+    def _memory_save(self):
+        if None in self._memory:
+            return
+        data = ''.join(map(chr, self._memory))
+        try:
+            atomic_write(self.memory_cache_path(), lambda f: f.write(data))
+        except (IOError, OSError):
+            pass
+
+    def _memory_read(self, sl):
         if sl.start is None:
             sl = slice(0, sl.stop)
         elif sl.start >= len(self._memory):
             sl = slice(len(self._memory), sl.stop)
         if sl.stop is None or sl.stop > len(self._memory):
             sl = slice(sl.start, len(self._memory))
-        address = sl.start
-        while address < sl.stop:
-            if self._memory[address] is None:
-                page = self.device.pbrmemr(slice(address, address + 8))
-                self._memory[address:address + len(page)] = page
-                address += len(page)
-            else:
-                address += 1
+        missing = [address for address in xrange(sl.start, sl.stop)
+                   if self._memory[address] is None]
+        if missing:
+            start, stop = missing[0], missing[-1] + 1
+            self._memory[start:stop] = self.device.pbrmemr(slice(start, stop))
+            self._memory_save()
         return ''.join(map(chr, self._memory[sl]))
 
+    def revalidate(self):
+        for key in 'routes', 'waypoints':
+            with self.lock(key):
+                self.revs[key] += 1
+
     def route_unlink(self, route):
         if not route.index:
             return False
-        self.device.pbrrtx(route)
-        if not self._routes is None:
-            self._routes = [r for r in self._routes if r != route]
+        try:
+            self.device.pbrrtx(route)
+        except Error:
+            self.revalidate()
+            raise
+        with self.lock('routes'):
+            fresh = not self._routes is None \
+                    and self._routes_rev == self.revs['routes'] \
+                    and route in self._routes
             self.revs['routes'] += 1
-            self._routes_rev = self.revs['routes']
-        self.revs['route_%s' % route.long_name] += 1
+            if fresh:
+                self._routes_set([r for r in self._routes if r != route],
+                                 self.revs['routes'])
+                self._snapshot_save()
+        self.revs['route_%s' % route.name] += 1
         return True
 
     def routes(self):
+        self._snapshot()
         if self._routes is None or self._routes_rev != self.revs['routes']:
-            self._routes = self.device.pbrrts()
-            self._routes_rev = self.revs['routes']
+            with self.lock('routes'):
+                if self._routes is None \
+                   or self._routes_rev != self.revs['routes']:
+                    rev = self.revs['routes']
+                    self._routes_set(self.device.pbrrts(), rev)
+                    self._stale.discard('routes')
+                    self._snapshot_save()
         return self._routes
 
+    def _routes_revalidate(self):
+        with self.lock('routes'):
+            if not 'routes' in self._stale:
+                return
+            routes = self.device.pbrrts()
+            self._stale.discard('routes')
+            def key(route):
+                return (route.index,
+                        [(rp.short_name, rp.long_name)
+                         for rp in route.routepoints])
+            old = dict((r.name, key(r)) for r in self._routes)
+            new = dict((r.name, key(r)) for r in routes)
+            changed = [name for name in set(old.keys()) | set(new.keys())
+                       if old.get(name) != new.get(name)]
+            if changed:
+                self.revs['routes'] += 1
+                self._routes_set(routes, self.revs['routes'])
+                self._snapshot_save()
+            for name in changed:
+                self.revs['route_%s' % name] += 1
+
+    def _routes_set(self, routes, rev):
+        index = defaultdict(list)
+        for route in routes:
+            for routepoint in route.routepoints:
+                if not route in index[routepoint.long_name]:
+                    index[routepoint.long_name].append(route)
+        self._routes_index = dict(index)
+        self._routes = routes
+        self._routes_rev = rev
+
+    def _snapshot(self):
+        if not self._snapshot_loaded:
+            with self.lock('snapshot'):
+                if not self._snapshot_loaded:
+                    self._snapshot_load()
+                    self._snapshot_loaded = True
+        if self._stale and self._snapshot_revalidator is None \
+           and time.time() >= self._snapshot_retry_time:
+            with self.lock('snapshot'):
+                if self._snapshot_revalidator is None:
+                    thread = threading.Thread(target=self._snapshot_revalidate,
+                                              name='SnapshotRevalidator')
+                    thread.setDaemon(True)
+                    self._snapshot_revalidator = thread
+                    thread.start()
+
+    def _snapshot_load(self):
+        try:
+            with open(self.get_cache_path('snapshot')) as file:
+                lines = file.read().split('\n')
+        except IOError:
+            return
+        sections = {}
+        try:
+            if lines.pop(0) != 'snapshot %d' % SNAPSHOT_VERSION:
+                return
+            while lines and lines[0]:
+                kind, n = lines.pop(0).split(' ')
+                sections[kind] = [line.split('\t')
+                                  for line in lines[:int(n)]]
+                del lines[:int(n)]
+            tracklogs = []
+            for fields in sections.get('tracklogs', []):
+                m = TRACKLOG_ID_RE.match(fields[2])
+                dt = datetime.datetime(*map(int, m.groups()))
+                dt = dt.replace(tzinfo=UTC())
+                duration = datetime.timedelta(seconds=int(fields[3]))
+                tracklog = Tracklog(int(fields[0]), int(fields[1]), dt,
+                                    duration)
+                tracklog.key = fields[4]
+                tracklogs.append(tracklog)
+            waypoints = [Waypoint(int(fields[0]), int(fields[1]),
+                                  fields[4], fields[5],
+                                  int(fields[2]), int(fields[3]))
+                         for fields in sections.get('waypoints', [])]
+            routes = [Route(int(fields[0]), fields[1],
+                            [Routepoint(*fields[i:i + 2])
+                             for i in xrange(2, len(fields), 2)])
+                      for fields in sections.get('routes', [])]
+        except (AttributeError, IndexError, ValueError):
+            return
+        if 'tracklogs' in sections and self._tracklogs is None:
+            self._tracklogs_name(tracklogs)
+            self._tracklogs_set(tracklogs)
+            self._stale.add('tracklogs')
+        if 'waypoints' in sections and self._waypoints is None:
+            self._waypoints_set(waypoints, self.revs['waypoints'])
+            self._stale.add('waypoints')
+        if 'routes' in sections and self._routes is None:
+            self._routes_set(routes, self.revs['routes'])
+            self._stale.add('routes')
+
+    def _snapshot_revalidate(self):
+        self.device.local.background = True
+        try:
+            for revalidate in (self._tracklogs_revalidate,
+                               self._waypoints_revalidate,
+                               self._routes_revalidate):
+                try:
+                    revalidate()
+                except (Error, IOError, NMEAError, OSError), e:
+                    self.logger.warning('%s failed: %r',
+                                        revalidate.__name__.strip('_'), e)
+        finally:
+            with self.lock('snapshot'):
+                if self._stale:
+                    self._snapshot_retry_time = \
+                        time.time() + self._snapshot_retry_delay
+                    self._snapshot_retry_delay = \
+                        min(2 * self._snapshot_retry_delay,
+                            SNAPSHOT_MAX_RETRY_DELAY)
+                else:
+                    self._snapshot_retry_delay = SNAPSHOT_RETRY_DELAY
+                self._snapshot_revalidator = None
+
+    def _snapshot_save(self):
+        lines = ['snapshot %d' % SNAPSHOT_VERSION]
+        tracklogs, waypoints, routes = \
+            self._tracklogs, self._waypoints, self._routes
+        if not tracklogs is None:
+            lines.append('tracklogs %d' % len(tracklogs))
+            for t in tracklogs:
+                lines.append('%d\t%d\t%s\t%d\t%s'
+                             % (t.count, t.index, t.id,
+                                86400 * t.duration.days + t.duration.seconds,
+                                t.key))
+        if not waypoints is None:
+            lines.append('waypoints %d' % len(waypoints))
+            for w in waypoints:
+                lines.append('%d\t%d\t%d\t%d\t%s\t%s'
+                             % (w.lat, w.lon, w.ele, w.type,
+                                w.short_name, w.long_name))
+        if not routes is None:
+            lines.append('routes %d' % len(routes))
+            for r in routes:
+                fields = [str(r.index), r.name]
+                for rp in r.routepoints:
+                    fields.extend((rp.short_name, rp.long_name))
+                lines.append('\t'.join(fields))
+        data = ''.join('%s\n' % line for line in lines)
+        with self.lock('snapshot'):
+            try:
+                atomic_write(self.get_cache_path('snapshot'),
+                             lambda f: f.write(data))
+            except (IOError, OSError):
+                pass
+
     def snp(self):
         if self._snp is None:
             self._snp = self.device.pbrsnp()
         return self._snp
 
+    def stats_status(self):
+        for name in 'hits', 'misses', 'evictions':
+            self.stats.set('flytec_cache_%s_total' % name, (),
+                           getattr(self.contents, name), 'counter')
+        self.stats.set('flytec_cache_bytes', (), self.contents.size)
+        self.stats.set('flytec_cache_entries', (), len(self.contents))
+        return self.stats.status()
+
+    def tracklog_cached(self, tracklog):
+        if hasattr(tracklog, '_content'):
+            return True
+        return tracklog.id in self.tracklog_pack()
+
     def tracklog_content(self, tracklog):
         if hasattr(tracklog, '_content'):
             return tracklog._content
-        cache_path = self.get_cache_path('tracklogs', 'contents', tracklog.id)
+        content = self.contents.get(tracklog.id)
+        if not content is None:
+            self.stats.count('flytec_tracklog_content_total',
+                             (('source', 'memory'),))
+            return content
+        with self.lock('tracklog_%s' % tracklog.id):
+            return self._tracklog_content(tracklog)
+
+    def _tracklog_content(self, tracklog):
+        if hasattr(tracklog, '_content'):
+            return tracklog._content
+        if tracklog.id in self.contents:
+            return self.contents.get(tracklog.id)
+        entry = self.tracklog_pack().get(tracklog.id)
+        if entry is None:
+            self.stats.count('flytec_tracklog_content_total',
+                             (('source', 'device'),))
+            download = self.tracklog_download(tracklog)
+            if not download is None:
+                download.wait()
+            return self._tracklog_content(tracklog)
+        self.stats.count('flytec_tracklog_content_total',
+                         (('source', 'pack'),))
+        content = self.tracklog_pack().mmap(entry)
+        self.contents.put(tracklog.id, content, entry.length)
+        return content
+
+    def tracklog_download(self, tracklog):
+        self._tracklogs_revalidate()
+        if not tracklog in self._tracklogs:
+            raise Error(tracklog.id)
+        with self.lock('downloads'):
+            download = self._downloads.get(tracklog.id)
+            if download is None:
+                if self.tracklog_cached(tracklog):
+                    return None
+                download = TracklogDownload(self, tracklog)
+                self._downloads[tracklog.id] = download
+                download.start()
+            elif not getattr(self.device.local, 'background', False):
+                download.foreground()
+        return download
+
+    def tracklog_read(self, tracklog, size, offset):
+        if not self.tracklog_cached(tracklog):
+            download = self.tracklog_download(tracklog)
+            if not download is None:
+                return download.read(size, offset)
+        return self.tracklog_content(tracklog)[offset:offset + size]
+
+    def tracklog_store(self, tracklog, content):
         try:
-            with open(cache_path) as file:
-                gzfile = GzipFile(None, 'r', None, file)
-                tracklog._content = gzfile.read()
-                gzfile.close()
-        except IOError:
-            tracklog._content = self.device.pbrtr(tracklog)
-            try:
-                dirname = os.path.dirname(cache_path)
-                if not os.path.exists(dirname):
-                    os.makedirs(dirname)
-                fd, tmppath = mkstemp('', '', dirname) 
-                try:
-                    with os.fdopen(fd, 'w') as file:
-                        gzfile = GzipFile(tracklog.igc_filename, 'w', 9, file)
-                        gzfile.write(tracklog._content)
-                        gzfile.close()
-                    os.rename(tmppath, cache_path)
-                except:
-                    os.remove(tmppath)
-                    raise
-            except IOError:
-                pass
-        return tracklog._content
+            self.tracklog_pack().append(tracklog.id, content, tracklog.filename)
+        except (IOError, OSError):
+            tracklog._content = content
+        self.revs['tracklog_%s' % tracklog.id] += 1
+
+    def tracklog_deflated(self, tracklog):
+        self.tracklog_content(tracklog)
+        entry = self.tracklog_pack().get(tracklog.id)
+        if entry is None:
+            if not hasattr(tracklog, '_deflated'):
+                tracklog._deflated = deflate(tracklog._content)
+            data = tracklog._deflated
+            def reader(n, o):
+                return data[o:o + n]
+            return (zlib.crc32(tracklog._content) & 0xffffffff,
+                    len(data),
+                    len(tracklog._content),
+                    reader)
+        def reader(n, o):
+            return self.tracklog_pack().read_deflated(tracklog.id, n, o)
+        return (entry.crc, entry.deflate_length, entry.length, reader)
+
+    def tracklog_pack(self):
+        if self._pack is None:
+            with self.lock('pack'):
+                if self._pack is None:
+                    pack = PackStore(self.get_cache_path('tracklogs'))
+                    self._tracklog_pack_migrate(pack)
+                    self._pack = pack
+        return self._pack
+
+    def _tracklog_pack_migrate(self, pack):
+        try:
+            for dirname in 'igc', 'contents':
+                path = self.get_cache_path('tracklogs', dirname)
+                if not os.path.isdir(path):
+                    continue
+                for name in os.listdir(path):
+                    file_path = os.path.join(path, name)
+                    if TRACKLOG_ID_RE.match(name) and not name in pack:
+                        with open(file_path) as file:
+                            if dirname == 'contents':
+                                content = GzipFile(None, 'r', None, file).read()
+                            else:
+                                content = file.read()
+                        pack.append(name, content, '')
+                    os.unlink(file_path)
+                os.rmdir(path)
+            index_path = self.get_cache_path('tracklogs', 'index')
+            if os.path.exists(index_path):
+                os.unlink(index_path)
+        except (IOError, OSError):
+            pass
+
+    def tracklog_get(self, filename):
+        self.tracklogs()
+        return self._tracklogs_index.get(filename)
 
     def tracklog_rename(self, tracklog, filename):
+        with self.lock('renames'):
+            renames = dict(self._tracklog_renames())
+            renames[tracklog.id] = filename
+            self._tracklog_renames_save(renames)
+        if self._tracklogs_index.get(tracklog.filename) is tracklog:
+            del self._tracklogs_index[tracklog.filename]
         tracklog.filename = filename
+        self._tracklogs_index[filename] = tracklog
+        if tracklog.id in self.tracklog_pack():
+            self.tracklog_pack().rename(tracklog.id, filename)
+        self._tracklog_views_remove(tracklog)
+        self.revs['tracklogs'] += 1
+
+    def _tracklog_renames(self):
+        if self._renames is None:
+            with self.lock('renames'):
+                if self._renames is None:
+                    self._renames = self._tracklog_renames_load()
+        return self._renames
+
+    def _tracklog_renames_load(self):
+        renames = {}
         try:
-            rename_path = self.get_cache_path('tracklogs', 'rename', tracklog.id)
-            dirname = os.path.dirname(rename_path)
-            if not os.path.exists(dirname):
-                os.makedirs(dirname)
-            if os.path.lexists(rename_path):
-                os.unlink(rename_path)
-            os.symlink(filename, rename_path)
+            with open(self.get_cache_path('tracklogs', 'renames')) as file:
+                for line in file:
+                    fields = line.rstrip('\n').split(' ', 1)
+                    if len(fields) == 2:
+                        renames[fields[0]] = fields[1].decode('string_escape')
         except IOError:
             pass
-        self.revs['tracklogs'] += 1
+        dirname = self.get_cache_path('tracklogs', 'rename')
+        if os.path.isdir(dirname):
+            try:
+                for id in os.listdir(dirname):
+                    path = os.path.join(dirname, id)
+                    if os.path.islink(path):
+                        renames.setdefault(id, os.readlink(path))
+                self._tracklog_renames_save(renames)
+                for id in os.listdir(dirname):
+                    os.unlink(os.path.join(dirname, id))
+                os.rmdir(dirname)
+            except (IOError, OSError):
+                pass
+        return renames
+
+    def _tracklog_renames_save(self, renames):
+        data = ''.join('%s %s\n' % (id, renames[id].encode('string_escape'))
+                       for id in sorted(renames.keys()))
+        try:
+            atomic_write(self.get_cache_path('tracklogs', 'renames'),
+                         lambda f: f.write(data))
+        except (IOError, OSError):
+            pass
+        self._renames = renames
+
+    def tracklog_deflated_size(self, tracklog):
+        entry = self.tracklog_pack().get(tracklog.id)
+        if not entry is None:
+            return (entry.deflate_length, True)
+        if hasattr(tracklog, '_deflated'):
+            return (len(tracklog._deflated), True)
+        return (self.tracklog_size(tracklog)[0], False)
+
+    def tracklog_size(self, tracklog):
+        entry = self.tracklog_pack().get(tracklog.id)
+        if not entry is None:
+            return (entry.length, True)
+        if hasattr(tracklog, '_content'):
+            return (len(tracklog._content), True)
+        seconds = 86400 * tracklog.duration.days + tracklog.duration.seconds
+        return (IGC_HEADER_SIZE + IGC_B_RECORD_SIZE * seconds, False)
+
+    def tracklog_track(self, tracklog):
+        track = self.contents.get('track_%s' % tracklog.id)
+        if not track is None:
+            return track
+        with self.lock('tracklog_%s' % tracklog.id):
+            path = self.get_cache_path('tracklogs', 'tracks', tracklog.id)
+            try:
+                with open(path) as file:
+                    track = igc.load(file)
+            except (IOError, ValueError):
+                content = self.tracklog_content(tracklog)
+                track = igc.parse(content, tracklog.dt.date())
+                try:
+                    atomic_write(path, track.save)
+                except (IOError, OSError):
+                    pass
+            self.contents.put('track_%s' % tracklog.id, track, track.nbytes())
+            return track
 
     def tracklog_unlink(self, tracklog):
-        cache_path = self.get_cache_path('tracklogs', 'contents', tracklog.id)
-        if os.path.exists(cache_path):
-            os.unlink(cache_path)
-        rename_path = self.get_cache_path('tracklogs', 'rename', tracklog.id)
-        if os.path.lexists(rename_path):
-            os.unlink(rename_path)
-        self._tracklogs = [t for t in self._tracklogs if t != tracklog]
+        self.tracklog_pack().remove(tracklog.id)
+        self.contents.pop(tracklog.id)
+        self.contents.pop('track_%s' % tracklog.id)
+        track_path = self.get_cache_path('tracklogs', 'tracks', tracklog.id)
+        if os.path.exists(track_path):
+            os.unlink(track_path)
+        self._tracklog_views_remove(tracklog)
+        for attr in '_content', '_deflated':
+            if hasattr(tracklog, attr):
+                delattr(tracklog, attr)
+        with self.lock('renames'):
+            if tracklog.id in self._tracklog_renames():
+                renames = dict(self._tracklog_renames())
+                del renames[tracklog.id]
+                self._tracklog_renames_save(renames)
+        self._tracklogs_set([t for t in self._tracklogs if t != tracklog])
+        self._snapshot_save()
         self.revs['tracklogs'] += 1
 
+    def tracklog_view_path(self, tracklog, extension):
+        return self.get_cache_path('tracklogs', 'tracks',
+                                   '%s.%s' % (tracklog.id, extension))
+
+    def tracklog_view_read(self, tracklog, extension, render, size, offset):
+        key = '%s_%s' % (extension, tracklog.id)
+        if self.tracklog_view_size(tracklog, extension) is None:
+            with self.lock('tracklog_%s' % tracklog.id):
+                if self.tracklog_view_size(tracklog, extension) is None:
+                    self._tracklog_view_render(tracklog, extension, render)
+        try:
+            with open(self.tracklog_view_path(tracklog, extension)) as file:
+                file.seek(offset)
+                return file.read(size)
+        except IOError:
+            pass
+        content = self.contents.get(key)
+        if content is None:
+            with self.lock('tracklog_%s' % tracklog.id):
+                content = self._tracklog_view_render(tracklog, extension,
+                                                     render)
+        return content[offset:offset + size]
+
+    def _tracklog_view_render(self, tracklog, extension, render):
+        key = '%s_%s' % (extension, tracklog.id)
+        labels = (('format', extension),)
+        with self.stats.timer('flytec_tracklog_view_seconds', labels):
+            content = ''.join(render(self.tracklog_track(tracklog)))
+        try:
+            atomic_write(self.tracklog_view_path(tracklog, extension),
+                         lambda f: f.write(content))
+        except (IOError, OSError):
+            self.contents.put(key, content, len(content))
+        self._views[key] = len(content)
+        return content
+
+    def tracklog_view_size(self, tracklog, extension):
+        key = '%s_%s' % (extension, tracklog.id)
+        if not key in self._views:
+            try:
+                path = self.tracklog_view_path(tracklog, extension)
+                self._views[key] = os.path.getsize(path)
+            except OSError:
+                return None
+        return self._views[key]
+
+    def _tracklog_views_remove(self, tracklog):
+        for key in [k for k in self._views if k.endswith('_' + tracklog.id)]:
+            self.contents.pop(key)
+            del self._views[key]
+        dirname = self.get_cache_path('tracklogs', 'tracks')
+        try:
+            for name in os.listdir(dirname):
+                if name.startswith(tracklog.id + '.'):
+                    os.unlink(os.path.join(dirname, name))
+        except OSError:
+            pass
+
     def tracklogs(self):
+        self._snapshot()
         if not self._tracklogs is None:
             return self._tracklogs
-        self._tracklogs = self.device.pbrtl()
-        snp = self.snp()
-        serial_number = re.sub(r'\A0+', '', snp.serial_number)
-        dates = {}
-        for tracklog in self._tracklogs:
-            dates.setdefault(tracklog.dt.date(), set()).add(tracklog.dt.time())
-        cache_path = self.get_cache_path('tracklogs', 'contents')
-        if os.path.exists(cache_path):
-            for path in listdir(cache_path):
-                m = TRACKLOG_ID_RE.match(path)
+        with self.lock('tracklogs'):
+            return self._tracklogs_list()
+
+    def _tracklogs_list(self):
+        if not self._tracklogs is None:
+            return self._tracklogs
+        self._tracklogs_set(self._tracklogs_discover({})[0])
+        self._stale.discard('tracklogs')
+        self._snapshot_save()
+        return self._tracklogs
+
+    def _tracklog_dates(self):
+        if self._dates is None:
+            dates = defaultdict(list)
+            for entry in self.tracklog_pack():
+                m = TRACKLOG_ID_RE.match(entry.id)
                 if m:
                     date = datetime.date(*map(int, m.groups()[0:3]))
                     time = datetime.time(*map(int, m.groups()[3:6]))
-                    dates.setdefault(date, set()).add(time)
-        for date, _set in dates.items():
-            dates[date] = sorted(_set)
-        for tracklog in self._tracklogs:
+                    dates[date].append(time)
+            for times in dates.values():
+                times.sort()
+            self._dates = dates
+        return self._dates
+
+    def _tracklogs_discover(self, known):
+        tracklogs = []
+        indexes = []
+        for sentence in self.device.ipbrtl_sentences():
+            fields = sentence.split(',', 3)
+            tracklog = known.get(fields[-1])
+            if tracklog is None:
+                m = PBRTL_RE.match(sentence)
+                if m is None:
+                    raise Error(sentence)
+                tracklog = pbrtl_tracklog(m)
+                tracklog.key = fields[-1]
+            try:
+                indexes.append((int(fields[1]), int(fields[2])))
+            except ValueError:
+                raise Error(sentence)
+            tracklogs.append(tracklog)
+        for tracklog, (count, index) in zip(tracklogs, indexes):
+            tracklog.count, tracklog.index = count, index
+        return (tracklogs, self._tracklogs_name(tracklogs))
+
+    def _tracklogs_name(self, tracklogs):
+        dates = self._tracklog_dates()
+        changed = set()
+        for tracklog in tracklogs:
+            if hasattr(tracklog, 'id'):
+                continue
             tracklog.id = tracklog.dt.strftime('%Y-%m-%dT%H:%M:%SZ')
-            index = dates[tracklog.dt.date()].index(tracklog.dt.time()) + 1
+            times = dates[tracklog.dt.date()]
+            i = bisect_left(times, tracklog.dt.time())
+            if i == len(times) or times[i] != tracklog.dt.time():
+                times.insert(i, tracklog.dt.time())
+            changed.add(tracklog.dt.date())
+        if not changed:
+            return []
+        snp = self.snp()
+        serial_number = re.sub(r'\A0+', '', snp.serial_number)
+        renames = self._tracklog_renames()
+        renamed = []
+        for tracklog in tracklogs:
+            if not tracklog.dt.date() in changed:
+                continue
+            index = bisect_left(dates[tracklog.dt.date()],
+                                tracklog.dt.time()) + 1
             tracklog.igc_filename = '%s-%s-%s-%02d.IGC' \
                                     % (tracklog.dt.strftime('%Y-%m-%d'),
                                        snp.manufacturer[1],
                                        serial_number,
                                        index)
-            rename_path = self.get_cache_path('tracklogs',
-                                              'rename',
-                                              tracklog.id)
-            if os.path.islink(rename_path):
-                tracklog.filename = os.readlink(rename_path)
-            else:
-                tracklog.filename = tracklog.igc_filename
-            date = tracklog.dt.date()
-        return self._tracklogs
+            filename = renames.get(tracklog.id, tracklog.igc_filename)
+            if getattr(tracklog, 'filename', filename) != filename:
+                renamed.append(tracklog)
+            tracklog.filename = filename
+            entry = self.tracklog_pack().get(tracklog.id)
+            if not entry is None and entry.filename != tracklog.filename:
+                self.tracklog_pack().rename(tracklog.id, tracklog.filename)
+        return renamed
+
+    def _tracklogs_revalidate(self):
+        if not 'tracklogs' in self._stale:
+            return
+        with self.lock('tracklogs'):
+            if not 'tracklogs' in self._stale:
+                return
+            old = dict((t.id, t) for t in self._tracklogs)
+            tracklogs, renamed = self._tracklogs_discover(
+                dict((t.key, t) for t in self._tracklogs))
+            self._stale.discard('tracklogs')
+            changed = [t for t in tracklogs if not old.get(t.id) is t]
+            changed.extend(renamed)
+            removed = set(old.keys()) - set(t.id for t in tracklogs)
+            self._tracklogs_set(tracklogs)
+            self._snapshot_save()
+            for tracklog in changed:
+                self.revs['tracklog_%s' % tracklog.id] += 1
+            if changed or removed:
+                self.revs['tracklogs'] += 1
+
+    def _tracklogs_set(self, tracklogs):
+        self._tracklogs_index = dict((t.filename, t) for t in tracklogs)
+        self._tracklogs = tracklogs
 
     def waypoint_create(self, waypoint):
-        self.device.pbrwpr(waypoint)
-        self.revs['waypoints'] += 1
-        self.revs['waypoint_%s' % waypoint.long_name] += 1
+        try:
+            self.device.pbrwpr(waypoint)
+        except Error:
+            self.revalidate()
+            raise
+        self._waypoints_update([pbrwpr_waypoint(waypoint)])
 
     def waypoint_get(self, long_name):
-        for waypoint in self.waypoints():
-            if waypoint.long_name == long_name:
-                return waypoint
-        return None
+        self.waypoints()
+        return self._waypoints_index.get(long_name)
+
+    def waypoint_routes(self, waypoint):
+        self.routes()
+        return self._routes_index.get(waypoint.long_name, [])
 
     def waypoint_unlink(self, waypoint):
-        for route in self.routes():
-            if any(waypoint.long_name == rp.long_name
-                   for rp in route.routepoints):
-                return False
-        self.device.pbrwpx(waypoint)
-        self.revs['waypoints'] += 1
-        self._waypoints = [w for w in self._waypoints if w != waypoint]
-        self._waypoints_rev = self.revs['waypoints']
+        if self.waypoint_routes(waypoint):
+            return False
+        try:
+            self.device.pbrwpx(waypoint)
+        except Error:
+            self.revalidate()
+            raise
+        with self.lock('waypoints'):
+            fresh = not self._waypoints is None \
+                    and self._waypoints_rev == self.revs['waypoints'] \
+                    and waypoint in self._waypoints
+            self.revs['waypoints'] += 1
+            if fresh:
+                self._waypoints_set([w for w in self._waypoints
+                                     if w != waypoint],
+                                    self.revs['waypoints'])
+                self._snapshot_save()
         self.revs['waypoint_%s' % waypoint.long_name] += 1
         return True
 
+    def waypoint_types(self):
+        if self._waypoint_types is None:
+            try:
+                waypoints = self.device.pbrwpse()
+                self._waypoint_types = len(waypoints) == len(self.waypoints())
+            except Error:
+                self._waypoint_types = False
+        return self._waypoint_types
+
+    def waypoints_upload(self, waypoints):
+        current = dict((w.long_name, w) for w in self.waypoints())
+        new = set()
+        pending = {}
+        for waypoint in waypoints:
+            name = pbrwpr_name(waypoint)
+            other = current.get(name)
+            if other is None:
+                if not name in new:
+                    if len(current) + len(new) >= WAYPOINT_CAPACITY:
+                        return False
+                    new.add(name)
+            elif (other.lat, other.lon, other.ele) \
+                 == (waypoint.lat, waypoint.lon, waypoint.ele) \
+                 and other.type in (0, waypoint.type):
+                pending.pop(name, None)
+                continue
+            pending[name] = waypoint
+        if not pending:
+            return True
+        types = any(w.type for w in pending.values()) and self.waypoint_types()
+        changes = []
+        try:
+            with self.device.batch('PBRWPR'):
+                for name in sorted(pending.keys()):
+                    waypoint = pending[name]
+                    if waypoint.type and types:
+                        self.device.pbrwpre(waypoint)
+                    else:
+                        self.device.pbrwpr(waypoint)
+                    changes.append(pbrwpr_waypoint(waypoint))
+        except Error:
+            self.revalidate()
+            raise
+        finally:
+            if changes:
+                self._waypoints_update(changes)
+        return True
+
     def waypoints(self):
+        self._snapshot()
         if self._waypoints is None \
            or self._waypoints_rev != self.revs['waypoints']:
-            self._waypoints = self.device.pbrwps()
-            self._waypoints_rev = self.revs['waypoints']
+            with self.lock('waypoints'):
+                if self._waypoints is None \
+                   or self._waypoints_rev != self.revs['waypoints']:
+                    rev = self.revs['waypoints']
+                    self._waypoints_set(self.device.pbrwps(), rev)
+                    self._stale.discard('waypoints')
+                    self._snapshot_save()
         return self._waypoints
+
+    def _waypoints_revalidate(self):
+        with self.lock('waypoints'):
+            if not 'waypoints' in self._stale:
+                return
+            waypoints = self.device.pbrwps()
+            self._stale.discard('waypoints')
+            def key(w):
+                return (w.lat, w.lon, w.short_name, w.ele, w.type)
+            old = dict((w.long_name, key(w)) for w in self._waypoints)
+            new = dict((w.long_name, key(w)) for w in waypoints)
+            changed = [name for name in set(old.keys()) | set(new.keys())
+                       if old.get(name) != new.get(name)]
+            if changed:
+                self.revs['waypoints'] += 1
+                self._waypoints_set(waypoints, self.revs['waypoints'])
+                self._snapshot_save()
+            for name in changed:
+                self.revs['waypoint_%s' % name] += 1
+
+    def _waypoints_update(self, changes):
+        latest = dict((w.long_name, w) for w in changes)
+        with self.lock('waypoints'):
+            fresh = not self._waypoints is None \
+                    and self._waypoints_rev == self.revs['waypoints']
+            self.revs['waypoints'] += 1
+            if fresh:
+                waypoints = [w for w in self._waypoints
+                             if not w.long_name in latest]
+                waypoints.extend(w for w in changes
+                                 if latest[w.long_name] is w)
+                self._waypoints_set(waypoints, self.revs['waypoints'])
+                self._snapshot_save()
+        for name in latest:
+            self.revs['waypoint_%s' % name] += 1
+
+    def _waypoints_set(self, waypoints, rev):
+        self._waypoints_index = dict((w.long_name, w) for w in waypoints)
+        self._waypoints = waypoints
+        self._waypoints_rev = rev
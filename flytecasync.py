@@ -0,0 +1,296 @@
+#   Flytec/Brauniger asynchronous device driver
+#   Copyright (C) 2008  Tom Payne
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import errno
+import heapq
+from itertools import count
+import logging
+import os
+
+import gobject
+
+from flytecdevice import COMMAND_PRIORITIES, DEFAULT_PRIORITY, READ_SIZE
+from flytecdevice import PBRMEMR_RE, PBRSNP_RE, PBRTL_RE
+from flytecdevice import PBRWPS_RE, PBRWPSE_RE, XOFF, XON
+from flytecdevice import Error, ProtocolError, ReadError, TimeoutError
+from flytecdevice import POSIXSerialIO
+from flytecdevice import nmea_decode_all, scan
+from flytecdevice import pbrmemr_page, pbrrts_routes, pbrsnp_snp
+from flytecdevice import pbrtl_tracklog, pbrwps_waypoint
+from flytecdevice import pbrwpr_command, pbrwpre_command
+
+
+def one(results):
+    if len(results) != 1:
+        raise Error(results)
+    return results[0]
+
+
+def none(results):
+    if results:
+        raise Error(results[0])
+
+
+class Request(object):
+
+    def __init__(self, command, re, timeout, convert, finish, each, callback,
+                 errback):
+        self.command = command
+        self.re = re
+        self.timeout = timeout
+        self.convert = convert
+        self.finish = finish
+        self.each = each
+        self.callback = callback
+        self.errback = errback
+        self.results = []
+        self.started = False
+
+
+class AsyncFlytecDevice(object):
+
+    def __init__(self, file_or_path):
+        if isinstance(file_or_path, str):
+            self.io = POSIXSerialIO(file_or_path)
+        else:
+            self.io = file_or_path
+        self.snp = None
+        self.logger = logging.getLogger(__name__)
+        self.sequence = count()
+        self.requests = []
+        self.request = None
+        self.buffer = ''
+        self.start = 0
+        self.timer = None
+        self.watch = gobject.io_add_watch(self.io.fd,
+                                          gobject.IO_IN | gobject.IO_ERR
+                                          | gobject.IO_HUP,
+                                          self.readable)
+
+    def close(self):
+        if not self.watch is None:
+            gobject.source_remove(self.watch)
+            self.watch = None
+        self.cancel_timer()
+        requests = [request for priority, seq, request in self.requests]
+        if not self.request is None:
+            requests.insert(0, self.request)
+        self.request = None
+        self.requests = []
+        for request in requests:
+            if request.errback:
+                request.errback(Error('closed'))
+        self.io.close()
+
+    def submit(self, command, re=None, timeout=1, convert=None, finish=None,
+               each=None, callback=None, errback=None):
+        request = Request(command, re, timeout, convert, finish, each,
+                          callback, errback)
+        priority = COMMAND_PRIORITIES.get(command.split(',')[0],
+                                          DEFAULT_PRIORITY)
+        heapq.heappush(self.requests, (priority, self.sequence.next(), request))
+        if self.request is None:
+            self.next()
+        return request
+
+    def next(self):
+        while self.request is None and self.requests:
+            self.request = heapq.heappop(self.requests)[2]
+            self.buffer = ''
+            self.start = 0
+            try:
+                self.io.writeline(self.request.command.encode('nmea_sentence'))
+            except (Error, OSError, UnicodeError), e:
+                self.fail(e)
+                continue
+            self.start_timer()
+
+    def start_timer(self):
+        self.cancel_timer()
+        self.timer = gobject.timeout_add(int(self.request.timeout * 1000),
+                                         self.expire)
+
+    def cancel_timer(self):
+        if not self.timer is None:
+            gobject.source_remove(self.timer)
+            self.timer = None
+
+    def expire(self):
+        self.timer = None
+        self.fail(TimeoutError())
+        return False
+
+    def fail(self, error):
+        request = self.request
+        self.request = None
+        self.cancel_timer()
+        self.buffer = ''
+        self.start = 0
+        self.io.flush()
+        gobject.idle_add(self.next)
+        if request.errback:
+            request.errback(error)
+        else:
+            self.logger.warning('%s failed: %r' % (request.command, error))
+
+    def complete(self):
+        request = self.request
+        self.request = None
+        self.cancel_timer()
+        try:
+            if request.finish is None:
+                result = request.results
+            else:
+                result = request.finish(request.results)
+        except Error, e:
+            self.request = request
+            self.fail(e)
+            return
+        gobject.idle_add(self.next)
+        if request.callback:
+            request.callback(result)
+
+    def readable(self, fd, condition):
+        try:
+            data = os.read(fd, READ_SIZE)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return True
+            data = ''
+        if not data:
+            self.watch = None
+            if not self.request is None:
+                self.fail(ReadError())
+            return False
+        if self.request is None:
+            return True
+        self.buffer = self.buffer[self.start:] + data
+        self.start = 0
+        while not self.request is None:
+            lines, self.start = scan(self.buffer, self.start)
+            if not lines:
+                break
+            self.io.log(lines)
+            try:
+                self.response(lines)
+            except (Error, UnicodeError), e:
+                if self.request is None:
+                    raise
+                self.fail(e)
+        if not self.request is None:
+            self.start_timer()
+        return True
+
+    def response(self, lines):
+        request = self.request
+        if not request.started:
+            if lines != [XOFF]:
+                raise ProtocolError(lines)
+            request.started = True
+        elif lines == [XON]:
+            self.complete()
+        elif lines == [XOFF]:
+            raise ProtocolError(lines)
+        else:
+            if request.re is None:
+                results = lines
+            else:
+                results = []
+                for sentence in nmea_decode_all(lines):
+                    m = request.re.match(sentence)
+                    if m is None:
+                        raise Error(sentence)
+                    results.append(m)
+            if request.convert:
+                results = map(request.convert, results)
+            request.results.extend(results)
+            if request.each:
+                for result in results:
+                    request.each(result)
+
+    def pbrconf(self, callback=None, errback=None):
+        return self.submit('PBRCONF,', timeout=4, finish=none,
+                           callback=callback, errback=errback)
+
+    def pbrigc(self, callback=None, errback=None, each=None):
+        return self.submit('PBRIGC,', finish=''.join, each=each,
+                           callback=callback, errback=errback)
+
+    def pbrmemr(self, sl, callback=None, errback=None):
+        result = []
+        def page(address):
+            self.submit('PBRMEMR,%04X' % address, PBRMEMR_RE,
+                        convert=pbrmemr_page, finish=one,
+                        callback=lambda page: received(address, *page),
+                        errback=errback)
+        def received(address, a, data):
+            if a != address or not data:
+                if errback:
+                    errback(ProtocolError())
+                return
+            result.extend(data)
+            if address + len(data) < sl.stop:
+                page(address + len(data))
+            elif callback:
+                callback(result[:sl.stop - sl.start])
+        page(sl.start)
+
+    def pbrrts(self, callback=None, errback=None):
+        def finish(lines):
+            return list(pbrrts_routes(nmea_decode_all(lines)))
+        return self.submit('PBRRTS,', finish=finish,
+                           callback=callback, errback=errback)
+
+    def pbrrtx(self, route, callback=None, errback=None):
+        return self.submit('PBRRTX,%s' % route.name, timeout=4, finish=none,
+                           callback=callback, errback=errback)
+
+    def pbrsnp(self, callback=None, errback=None):
+        def snp(snp):
+            self.snp = snp
+            if callback:
+                callback(snp)
+        return self.submit('PBRSNP,', PBRSNP_RE, convert=pbrsnp_snp,
+                           finish=one, callback=snp, errback=errback)
+
+    def pbrtl(self, callback=None, errback=None, each=None):
+        return self.submit('PBRTL,', PBRTL_RE, convert=pbrtl_tracklog,
+                           each=each, callback=callback, errback=errback)
+
+    def pbrtr(self, tracklog, callback=None, errback=None, each=None):
+        return self.submit('PBRTR,%02d' % tracklog.index, finish=''.join,
+                           each=each, callback=callback, errback=errback)
+
+    def pbrwpr(self, waypoint, callback=None, errback=None):
+        return self.submit(pbrwpr_command(waypoint), finish=none,
+                           callback=callback, errback=errback)
+
+    def pbrwpre(self, waypoint, callback=None, errback=None):
+        return self.submit(pbrwpre_command(waypoint), finish=none,
+                           callback=callback, errback=errback)
+
+    def pbrwps(self, callback=None, errback=None, each=None):
+        return self.submit('PBRWPS,', PBRWPS_RE, convert=pbrwps_waypoint,
+                           each=each, callback=callback, errback=errback)
+
+    def pbrwpse(self, callback=None, errback=None, each=None):
+        return self.submit('PBRWPSE,', PBRWPSE_RE, convert=pbrwps_waypoint,
+                           each=each, callback=callback, errback=errback)
+
+    def pbrwpx(self, waypoint, callback=None, errback=None):
+        return self.submit('PBRWPX,%s' % waypoint.long_name, timeout=8,
+                           finish=none, callback=callback, errback=errback)
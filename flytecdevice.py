@@ -15,12 +15,24 @@
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+from __future__ import with_statement
+
+from array import array
 from codecs import Codec, CodecInfo
 import codecs
+from contextlib import contextmanager
 from datetime import datetime, timedelta, tzinfo
+import heapq
+from itertools import count
 import logging
+from operator import xor
 import os
 import re
+import sys
+import threading
+import time
+
+from stats import Stats
 
 
 class UTC(tzinfo):
@@ -37,14 +49,41 @@ class UTC(tzinfo):
 
 
 NMEA_ENCODE_RE = re.compile('\\A[\x20-\x7e]{1,79}\\Z')
-NMEA_DECODE_RE = re.compile('\\A\\$(.{1,79})\\*([0-9A-F]{2})\r\n\\Z')
 NMEA_INVALID_CHAR_RE = re.compile('[^\x20-\x7e]')
+NMEA_HEX_DIGITS = '0123456789ABCDEF'
+NMEA_WORD_SIZE = array('L').itemsize
+NMEA_PADDING = '\0' * NMEA_WORD_SIZE
+NMEA_FOLDS = [8 << i
+              for i in reversed(range(NMEA_WORD_SIZE.bit_length() - 1))]
 
 
 class NMEAError(UnicodeError):
     pass
 
 
+def nmea_checksum(data):
+    padding = NMEA_PADDING[len(data) % NMEA_WORD_SIZE or NMEA_WORD_SIZE:]
+    checksum = reduce(xor, array('L', data + padding), 0)
+    for shift in NMEA_FOLDS:
+        checksum ^= checksum >> shift
+    return checksum & 0xff
+
+
+def nmea_decode_all(lines):
+    result = []
+    for line in lines:
+        if len(line) < 7 or len(line) > 85 \
+           or line[0] != '$' or line[-5] != '*' or line[-2:] != '\r\n' \
+           or not line[-4] in NMEA_HEX_DIGITS \
+           or not line[-3] in NMEA_HEX_DIGITS:
+            raise NMEAError(line)
+        sentence = line[1:-5]
+        if '\n' in sentence or nmea_checksum(sentence) != int(line[-4:-2], 16):
+            raise NMEAError(line)
+        result.append(sentence)
+    return result
+
+
 class NMEASentenceCodec(Codec):
 
     def decode(self, input, errors='strict'):
@@ -52,15 +91,7 @@ class NMEASentenceCodec(Codec):
             raise NotImplementedError
         if not input:
             return ('', 0)
-        m = NMEA_DECODE_RE.match(input)
-        if not m:
-            raise NMEAError(input)
-        checksum = 0
-        for c in m.group(1):
-            checksum ^= ord(c)
-        if checksum != ord(m.group(2).decode('hex')):
-            raise NMEAError(input)
-        return (m.group(1), len(input))
+        return (nmea_decode_all([input])[0], len(input))
 
     def encode(self, input, errors='strict'):
         if errors != 'strict':
@@ -69,10 +100,7 @@ class NMEASentenceCodec(Codec):
             return ('', 0)
         if not NMEA_ENCODE_RE.match(input):
             raise NMEAError(input)
-        checksum = 0
-        for c in input:
-            checksum ^= ord(c)
-        return ('$%s*%02X\r\n' % (input, checksum), len(input))
+        return ('$%s*%02X\r\n' % (input, nmea_checksum(input)), len(input))
 
 
 class NMEACharacterCodec(object):
@@ -99,6 +127,13 @@ codecs.register(nmea_search)
 XON = '\021'
 XOFF = '\023'
 
+LINE_RE = re.compile(r'[^\n]*\n')
+READ_SIZE = 4096
+
+PBRMEMR_PAGE_SIZE = 8
+PBRMEMR_PIPELINE_DEPTH = 8
+PBRMEMR_DRAIN_TIMEOUT = 0.5
+
 PBRMEMR_RE = re.compile(r'\APBRMEMR,([0-9A-F]+),([0-9A-F]+(?:,[0-9A-F]+)*)\Z')
 PBRRTS_RE1 = re.compile(r'\APBRRTS,(\d+),(\d+),0+,(.*)\Z')
 PBRRTS_RE2 = re.compile(r'\APBRRTS,(\d+),(\d+),(\d+),([^,]*),(.*?)\Z')
@@ -113,6 +148,25 @@ PBRWPSE_RE = re.compile(r'\APBRWPS,(\d{2})(\d{2})\.(\d{3}),([NS]),'
                         r'(\d+)\Z')
 
 
+COMMAND_PRIORITIES = {
+    'PBRMEMR': 0,
+    'PBRRTS': 0,
+    'PBRSNP': 0,
+    'PBRTL': 0,
+    'PBRWPS': 0,
+    'PBRWPSE': 0,
+    'PBRCONF': 1,
+    'PBRRTX': 1,
+    'PBRWPR': 1,
+    'PBRWPRE': 1,
+    'PBRWPX': 1,
+    'PBRIGC': 2,
+    'PBRTR': 2,
+    }
+DEFAULT_PRIORITY = 1
+BACKGROUND_PRIORITY = 3
+
+
 class Error(RuntimeError): pass
 class TimeoutError(Error): pass
 class ReadError(Error): pass
@@ -120,45 +174,84 @@ class WriteError(Error): pass
 class ProtocolError(Error): pass
 
 
+def scan(buffer, start):
+    if start < len(buffer):
+        c = buffer[start]
+        if c == XON or c == XOFF:
+            return ([c], start + 1)
+        end = buffer.rfind('\n', start) + 1
+        for control in XON, XOFF:
+            index = buffer.find(control, start, end)
+            if index != -1:
+                end = index
+        if end > start and buffer[end - 1] != '\n':
+            line_start = buffer.rfind('\n', start, end) + 1 or start
+            line_end = buffer.find('\n', end) + 1
+            line = buffer[line_start:line_end]
+            line = line.replace(XON, '').replace(XOFF, '')
+            return (LINE_RE.findall(buffer, start, line_start) + [line],
+                    line_end)
+        if end > start:
+            return (LINE_RE.findall(buffer, start, end), end)
+    return ([], start)
+
+
 class SerialIO(object):
 
     def __init__(self, filename):
         self.logger = logging.getLogger('%s.%s' % (__name__, filename))
         self.buffer = ''
+        self.start = 0
+        self.pending = []
+
+    def drain(self, timeout):
+        self.flush()
+        try:
+            while True:
+                self.read(READ_SIZE, timeout)
+        except TimeoutError:
+            pass
+
+    def fill(self, timeout):
+        self.buffer = self.buffer[self.start:] + self.read(READ_SIZE, timeout)
+        self.start = 0
+
+    def log(self, lines):
+        if self.logger.isEnabledFor(logging.INFO):
+            for line in lines:
+                self.logger.info('%s', line.encode('string_escape'),
+                                 extra=dict(direction='read'))
 
     def readline(self, timeout):
-        if self.buffer == '':
-            self.buffer = self.read(1024, timeout)
-        if self.buffer[0] == XON or self.buffer[0] == XOFF:
-            result = self.buffer[0]
-            self.buffer = self.buffer[1:]
-            self.logger.info('%s', result.encode('string_escape'),
-                             extra=dict(direction='read'))
+        while not self.pending:
+            self.pending = self.readlines(timeout)
+            self.pending.reverse()
+        return self.pending.pop()
+
+    def readlines(self, timeout):
+        if self.pending:
+            result, self.pending = self.pending[::-1], []
             return result
-        else:
-            result = ''
-            while True:
-                index = self.buffer.find('\n')
-                if index == -1:
-                    result += self.buffer
-                    self.buffer = self.read(1024, timeout)
-                else:
-                    result += self.buffer[0:index + 1]
-                    self.buffer = self.buffer[index + 1:]
-                    self.logger.info('%s', result.encode('string_escape'),
-                                     extra=dict(direction='read'))
-                    return result
+        while True:
+            result, self.start = scan(self.buffer, self.start)
+            if result:
+                self.log(result)
+                return result
+            self.fill(timeout)
 
     def writeline(self, line):
-        self.logger.info('%s', line.encode('string_escape'),
-                         extra=dict(direction='write'))
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info('%s', line.encode('string_escape'),
+                             extra=dict(direction='write'))
         self.write(line)
 
     def close(self):
         pass
 
     def flush(self):
-        pass
+        self.buffer = ''
+        self.start = 0
+        self.pending = []
 
     def read(self, n):
         raise NotImplementedError
@@ -186,6 +279,7 @@ class POSIXSerialIO(SerialIO):
         os.close(self.fd)
 
     def flush(self):
+        SerialIO.flush(self)
         tty.tcflush(self.fd, tty.TCIOFLUSH)
 
     def read(self, n, timeout):
@@ -201,6 +295,56 @@ class POSIXSerialIO(SerialIO):
             raise WriteError()
 
 
+class Scheduler(object):
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.depth = 0
+        self.owner = None
+        self.promotions = {}
+        self.sequence = count()
+        self.waiters = []
+
+    def acquire(self, priority):
+        thread = threading.currentThread()
+        with self.condition:
+            if self.owner is thread:
+                self.depth += 1
+                return
+            priority = min(priority, self.promotions.pop(thread, priority))
+            waiter = (priority, self.sequence.next(), thread)
+            heapq.heappush(self.waiters, waiter)
+            while not self.owner is None or self.waiters[0][2] is not thread:
+                self.condition.wait()
+            heapq.heappop(self.waiters)
+            self.owner = thread
+            self.depth = 1
+
+    def promote(self, thread, priority):
+        with self.condition:
+            if self.owner is thread:
+                return
+            for i, waiter in enumerate(self.waiters):
+                if waiter[2] is thread:
+                    if priority < waiter[0]:
+                        self.waiters[i] = (priority, waiter[1], thread)
+                        heapq.heapify(self.waiters)
+                        self.condition.notifyAll()
+                    return
+            for other in self.promotions.keys():
+                if not other.isAlive():
+                    del self.promotions[other]
+            if thread.isAlive():
+                self.promotions[thread] = priority
+
+    def release(self):
+        with self.condition:
+            self.depth -= 1
+            if self.depth == 0:
+                self.owner = None
+                self.condition.notifyAll()
+
+
 class _Struct:
 
     def __repr__(self):
@@ -248,7 +392,7 @@ class Tracklog(_Struct):
 
 class Waypoint(_Struct):
 
-    def __init__(self, lat, lon, short_name, long_name, ele, type):
+    def __init__(self, lat, lon, short_name, long_name, ele, type=0):
         self.lat = min(max(-(60000 * 180 - 1), lat), 60000 * 180 - 1)
         self.lon = min(max(-(60000 * 90 - 1), lon), 60000 * 90 - 1)
         self.short_name = '%-6s' % short_name.encode('nmea_characters',
@@ -270,9 +414,84 @@ class Waypoint(_Struct):
         return '%s,%s' % (lat, lon)
 
 
+def pbrmemr_page(m):
+    return (int(m.group(1), 16),
+            [int(byte, 16) for byte in m.group(2).split(',')])
+
+
+def pbrrts_routes(sentences):
+    for sentence in sentences:
+        m = PBRRTS_RE1.match(sentence)
+        if m:
+            index, count = map(int, m.groups()[0:2])
+            name = m.group(3)
+            if count == 1:
+                yield Route(index, name, [])
+            else:
+                routepoints = []
+            continue
+        m = PBRRTS_RE2.match(sentence)
+        if m:
+            index, count, routepoint_index = map(int, m.groups()[0:3])
+            short_name, long_name = m.groups()[3:5]
+            routepoint = Routepoint(short_name, long_name)
+            routepoints.append(routepoint)
+            if routepoint_index == count - 1:
+                yield Route(index, name, routepoints)
+            continue
+        raise Error(sentence)
+
+
+def pbrsnp_snp(m):
+    return SNP(*m.groups())
+
+
+def pbrtl_tracklog(m):
+    count, index = map(int, m.groups()[0:2])
+    day, month, year, hour, minute, second = map(int, m.groups()[2:8])
+    dt = datetime(year + 2000, month, day, hour, minute, second, tzinfo=UTC())
+    hours, minutes, seconds = map(int, m.groups()[8:11])
+    duration = timedelta(hours=hours, minutes=minutes, seconds=seconds)
+    return Tracklog(count, index, dt, duration)
+
+
+def pbrwps_waypoint(m):
+    lat = sum(map(lambda x, y: int(x) * y, m.groups()[0:3], (60000, 1000, 1)))
+    if m.group(4) == 'S':
+        lat = -lat
+    lon = sum(map(lambda x, y: int(x) * y, m.groups()[4:7], (60000, 1000, 1)))
+    if m.group(8) == 'W':
+        lon = -lon
+    short_name, long_name = m.groups()[8:10]
+    ele = int(m.group(11))
+    type = int(m.group(12)) if m.re.groups > 11 else 0
+    return Waypoint(lat, lon, short_name, long_name, ele, type)
+
+
+def pbrwpr_name(waypoint):
+    return '%3s %13s' % (waypoint.short_name[:3], waypoint.long_name[:13])
+
+
+def pbrwpr_waypoint(waypoint):
+    name = pbrwpr_name(waypoint)
+    return Waypoint(waypoint.lat, waypoint.lon, name[:3], name, waypoint.ele,
+                    waypoint.type)
+
+
+def pbrwpr_command(waypoint):
+    return 'PBRWPR,%s,,%s,%04d' % (waypoint.nmea(), pbrwpr_name(waypoint),
+                                   waypoint.ele)
+
+
+def pbrwpre_command(waypoint):
+    return 'PBRWPRE,%s,,%s,%04d,%03d' % (waypoint.nmea(),
+                                         pbrwpr_name(waypoint),
+                                         waypoint.ele, waypoint.type)
+
+
 class FlytecDevice(object):
 
-    def __init__(self, file_or_path):
+    def __init__(self, file_or_path, stats=None):
         if isinstance(file_or_path, str):
             if os.name == 'posix':
                 self.io = POSIXSerialIO(file_or_path)
@@ -281,6 +500,12 @@ class FlytecDevice(object):
         else:
             self.io = file_or_path
         self.snp = None
+        self.scheduler = Scheduler()
+        self.local = threading.local()
+        self.logger = logging.getLogger(__name__)
+        self.pbrmemr_depth = PBRMEMR_PIPELINE_DEPTH
+        self.stats = Stats() if stats is None else stats
+        self.read_bytes = 0
 
     def __enter__(self):
         return self
@@ -291,25 +516,100 @@ class FlytecDevice(object):
     def close(self):
         self.io.close()
 
-    def ieach(self, command, re=None, timeout=1):
+    def priority(self, command):
+        priority = COMMAND_PRIORITIES.get(command.split(',')[0],
+                                          DEFAULT_PRIORITY)
+        if getattr(self.local, 'background', False):
+            priority += BACKGROUND_PRIORITY
+        return priority
+
+    def promote(self, thread, command):
+        self.scheduler.promote(thread, COMMAND_PRIORITIES.get(
+            command.split(',')[0], DEFAULT_PRIORITY))
+
+    @contextmanager
+    def batch(self, command):
+        self.scheduler.acquire(self.priority(command))
         try:
-            self.io.writeline(command.encode('nmea_sentence'))
-            if self.io.readline(timeout) != XOFF:
-                raise Error
-            while True:
-                line = self.io.readline(timeout)
-                if line == XON:
-                    break
-                elif re is None:
+            yield self
+        finally:
+            self.scheduler.release()
+
+    def iresponse(self, re=None, timeout=1):
+        if self.io.readline(timeout) != XOFF:
+            raise Error
+        while True:
+            lines = self.io.readlines(timeout)
+            if lines == [XON]:
+                return
+            self.read_bytes += sum(map(len, lines))
+            if re is None:
+                for line in lines:
                     yield line
-                else:
-                    m = re.match(line.decode('nmea_sentence'))
+            else:
+                for sentence in nmea_decode_all(lines):
+                    m = re.match(sentence)
                     if m is None:
-                        raise Error(line)
+                        raise Error(sentence)
                     yield m
+
+    def record(self, command, start, read_bytes, write_bytes, error=None):
+        labels = (('command', command.split(',')[0]),)
+        self.stats.observe('flytec_device_command_seconds', labels,
+                           time.time() - start)
+        self.stats.count('flytec_device_read_bytes_total', labels,
+                         self.read_bytes - read_bytes)
+        self.stats.count('flytec_device_write_bytes_total', labels,
+                         write_bytes)
+        if not error is None:
+            self.stats.count('flytec_device_errors_total',
+                             labels + (('error', error.__class__.__name__),))
+
+    def ieach(self, command, re=None, timeout=1):
+        self.scheduler.acquire(self.priority(command))
+        start, read_bytes = time.time(), self.read_bytes
+        line = command.encode('nmea_sentence')
+        try:
+            self.io.writeline(line)
+            for result in self.iresponse(re, timeout):
+                yield result
+        except GeneratorExit:
+            self.io.flush()
+            self.record(command, start, read_bytes, len(line))
+            raise
         except:
             self.io.flush()
+            self.record(command, start, read_bytes, len(line),
+                        sys.exc_info()[1])
             raise
+        else:
+            self.record(command, start, read_bytes, len(line))
+        finally:
+            self.scheduler.release()
+
+    def imany(self, commands, re=None, timeout=1):
+        self.scheduler.acquire(min(map(self.priority, commands)))
+        start, read_bytes = time.time(), self.read_bytes
+        lines = [command.encode('nmea_sentence') for command in commands]
+        index = 0
+        try:
+            for line in lines:
+                self.io.writeline(line)
+            for index, command in enumerate(commands):
+                result = list(self.iresponse(re, timeout))
+                self.record(command, start, read_bytes, len(lines[index]))
+                start, read_bytes = time.time(), self.read_bytes
+                yield result
+        except GeneratorExit:
+            self.io.flush()
+            raise
+        except:
+            self.io.flush()
+            self.record(commands[index], start, read_bytes, 0,
+                        sys.exc_info()[1])
+            raise
+        finally:
+            self.scheduler.release()
 
     def none(self, command, timeout=1):
         for m in self.ieach(command, timeout=timeout):
@@ -335,59 +635,59 @@ class FlytecDevice(object):
     def pbrmemr(self, sl):
         result = []
         address = sl.start
-        while address < sl.stop:
-            m = self.one('PBRMEMR,%04X' % address, PBRMEMR_RE)
-            if int(m.group(1), 16) != address:
-                raise ProtocolError()
-            data = [int(byte, 16) for byte in m.group(2).split(',')]
-            result.extend(data)
-            address += len(data)
+        with self.batch('PBRMEMR'):
+            while address < sl.stop:
+                addresses = range(address, sl.stop, PBRMEMR_PAGE_SIZE)
+                addresses = addresses[:self.pbrmemr_depth]
+                commands = ['PBRMEMR,%04X' % a for a in addresses]
+                try:
+                    pages = []
+                    for a, ms in zip(addresses, self.imany(commands,
+                                                           PBRMEMR_RE)):
+                        if len(ms) != 1:
+                            raise ProtocolError()
+                        page_address, data = pbrmemr_page(ms[0])
+                        if page_address != a:
+                            raise ProtocolError()
+                        if len(addresses) > 1 \
+                           and len(data) != PBRMEMR_PAGE_SIZE:
+                            raise ProtocolError()
+                        pages.append(data)
+                except (Error, NMEAError):
+                    if len(addresses) == 1:
+                        raise
+                    self.logger.info('PBRMEMR pipelining failed')
+                    self.io.drain(PBRMEMR_DRAIN_TIMEOUT)
+                    self.pbrmemr_depth = 1
+                    continue
+                for data in pages:
+                    result.extend(data)
+                    address += len(data)
         return result[:sl.stop - sl.start]
 
     def ipbrrts(self):
-        for line in self.ieach('PBRRTS,'):
-            line = line.decode('nmea_sentence')
-            m = PBRRTS_RE1.match(line)
-            if m:
-                index, count = map(int, m.groups()[0:2])
-                name = m.group(3)
-                if count == 1:
-                    yield Route(index, name, [])
-                else:
-                    routepoints = []
-                continue
-            m = PBRRTS_RE2.match(line)
-            if m:
-                index, count, routepoint_index = map(int, m.groups()[0:3])
-                short_name, long_name = m.groups()[3:5]
-                routepoint = Routepoint(short_name, long_name)
-                routepoints.append(routepoint)
-                if routepoint_index == count - 1:
-                    yield Route(index, name, routepoints)
-                continue
-            raise Error(line)
+        return pbrrts_routes(line.decode('nmea_sentence')
+                             for line in self.ieach('PBRRTS,'))
 
     def pbrrts(self):
         return list(self.ipbrrts())
 
     def pbrsnp(self):
         if self.snp is None:
-            self.snp = SNP(*self.one('PBRSNP,', PBRSNP_RE).groups())
+            self.snp = pbrsnp_snp(self.one('PBRSNP,', PBRSNP_RE))
         return self.snp
 
     def ipbrtl(self):
         for m in self.ieach('PBRTL,', PBRTL_RE):
-            count, index = map(int, m.groups()[0:2])
-            day, month, year, hour, minute, second = map(int, m.groups()[2:8])
-            dt = datetime(year + 2000, month, day, hour, minute, second,
-                          tzinfo=UTC())
-            hours, minutes, seconds = map(int, m.groups()[8:11])
-            duration = timedelta(hours=hours, minutes=minutes, seconds=seconds)
-            yield Tracklog(count, index, dt, duration)
+            yield pbrtl_tracklog(m)
 
     def pbrtl(self):
         return list(self.ipbrtl())
 
+    def ipbrtl_sentences(self):
+        for line in self.ieach('PBRTL,'):
+            yield line.decode('nmea_sentence')
+
     def ipbrtr(self, tracklog):
         return self.ieach('PBRTR,%02d' % tracklog.index)
 
@@ -398,45 +698,18 @@ class FlytecDevice(object):
         self.none('PBRRTX,%s' % route.name, timeout=4)
 
     def pbrwpr(self, waypoint):
-        name = '%3s %13s' % (waypoint.short_name[:3], waypoint.long_name[:13])
-        self.none('PBRWPR,%s,,%s,%04d' % (waypoint.nmea(), name, waypoint.ele))
+        self.none(pbrwpr_command(waypoint))
 
     def pbrwpre(self, waypoint):
-        name = '%3s %13s' % (waypoint.short_name[:3], waypoint.long_name[:13])
-        self.none('PBRWPRE,%s,,%s,%04d,%03d' % (waypoint.nmea(), name, waypoint.ele, waypoint.type))
+        self.none(pbrwpre_command(waypoint))
 
     def ipbrwps(self):
         for m in self.ieach('PBRWPS,', PBRWPS_RE):
-            lat = sum(map(lambda x, y: int(x) * y,
-                          m.groups()[0:3],
-                          (60000, 1000, 1)))
-            if m.group(4) == 'S':
-                lat = -lat
-            lon = sum(map(lambda x, y: int(x) * y,
-                          m.groups()[4:7],
-                          (60000, 1000, 1)))
-            if m.group(8) == 'W':
-                lon = -lon
-            short_name, long_name = m.groups()[8:10]
-            ele = int(m.group(11))
-            yield Waypoint(lat, lon, short_name, long_name, ele, 0)
+            yield pbrwps_waypoint(m)
 
     def ipbrwpse(self):
         for m in self.ieach('PBRWPSE,', PBRWPSE_RE):
-            lat = sum(map(lambda x, y: int(x) * y,
-                          m.groups()[0:3],
-                          (60000, 1000, 1)))
-            if m.group(4) == 'S':
-                lat = -lat
-            lon = sum(map(lambda x, y: int(x) * y,
-                          m.groups()[4:7],
-                          (60000, 1000, 1)))
-            if m.group(8) == 'W':
-                lon = -lon
-            short_name, long_name = m.groups()[8:10]
-            ele = int(m.group(11))
-            type = int(m.group(12))
-            yield Waypoint(lat, lon, short_name, long_name, ele, type)
+            yield pbrwps_waypoint(m)
 
     def pbrwps(self):
         return list(self.ipbrwps())
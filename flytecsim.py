@@ -0,0 +1,212 @@
+#   Flytec/Brauniger instrument simulator
+#   Copyright (C) 2008  Tom Payne
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import with_statement
+
+from datetime import datetime, timedelta
+import os
+import re
+import threading
+import time
+import tty
+
+from flytec import MEMORY_SIZE, WAYPOINT_CAPACITY
+from flytecdevice import NMEAError, Routepoint, Route, Waypoint
+from flytecdevice import XOFF, XON
+from flytecdevice import pbrwps_waypoint
+
+
+PBRWPR_RE = re.compile(r'\APBRWPR,(\d{2})(\d{2})\.(\d{3}),([NS]),'
+                       r'(\d{3})(\d{2})\.(\d{3}),([EW]),,(.{3}) (.{13}),'
+                       r'(-?\d+)\Z')
+PBRWPRE_RE = re.compile(r'\APBRWPRE,(\d{2})(\d{2})\.(\d{3}),([NS]),'
+                        r'(\d{3})(\d{2})\.(\d{3}),([EW]),,(.{3}) (.{13}),'
+                        r'(-?\d+),(\d+)\Z')
+
+
+def nmea(sentence):
+    return sentence.encode('nmea_sentence')
+
+
+class Simulator(object):
+
+    def __init__(self, tracklogs=10, waypoints=50, routes=3, duration=1800,
+                 interval=10, baud=57600, instrument='6030',
+                 pilot_name='Simulated Pilot', serial_number='01234',
+                 software_version='1.16'):
+        self.snp = (instrument, '%-16s' % pilot_name[:16], serial_number,
+                    software_version)
+        self.interval = interval
+        self.baud = baud
+        self.lock = threading.Lock()
+        self.contents = {}
+        now = datetime(2008, 7, 1, 10, 0, 0)
+        self.tracklogs = []
+        for i in xrange(tracklogs):
+            dt = now - timedelta(days=i // 2, hours=3 * (i % 2))
+            self.tracklogs.append((dt, timedelta(seconds=duration)))
+        self.waypoints = []
+        for i in xrange(waypoints):
+            self.waypoints.append(Waypoint(60000 * 46 + 97 * i,
+                                           60000 * 6 + 131 * i,
+                                           'W%05d' % i,
+                                           'WAYPOINT %04d' % i,
+                                           500 + 10 * i,
+                                           0))
+        self.routes = []
+        for i in xrange(min(routes, waypoints // 2 or 1)):
+            routepoints = [Routepoint(w.short_name, w.long_name)
+                           for w in self.waypoints[i:i + 3]]
+            self.routes.append(Route(i + 1, 'ROUTE %02d' % i, routepoints))
+        self.memory = [(7 * i) % 256 for i in xrange(MEMORY_SIZE)]
+
+    def tracklog_content(self, index):
+        if index in self.contents:
+            return self.contents[index]
+        dt, duration = self.tracklogs[index]
+        lines = ['AXFL%s\r\n' % self.snp[2],
+                 'HFDTE%s\r\n' % dt.strftime('%d%m%y'),
+                 'HFPLTPILOT:%s\r\n' % self.snp[1].rstrip(),
+                 'HFGTYGLIDERTYPE:Simulated\r\n']
+        for second in xrange(0, duration.seconds + 1, self.interval):
+            t = dt + timedelta(seconds=second)
+            lat = 60000 * 46 + (second // self.interval) % 6000
+            lon = 60000 * 6 + (3 * second // self.interval) % 6000
+            ele = 1000 + (second // self.interval) % 2000
+            lines.append('B%s%02d%05dN%03d%05dEA%05d%05d\r\n'
+                         % (t.strftime('%H%M%S'),
+                            lat // 60000, lat % 60000,
+                            lon // 60000, lon % 60000,
+                            ele, ele + 25))
+        self.contents[index] = lines
+        return lines
+
+    def respond(self, sentence):
+        fields = sentence.split(',')
+        command = fields[0]
+        if command == 'PBRSNP':
+            return [nmea('PBRSNP,%s,%s,%s,%s' % self.snp)]
+        elif command == 'PBRTL':
+            result = []
+            for index, (dt, duration) in enumerate(self.tracklogs):
+                hours, seconds = divmod(duration.seconds, 3600)
+                result.append(nmea('PBRTL,%02d,%02d,%s,%s,%02d:%02d:%02d'
+                                   % (len(self.tracklogs), index,
+                                      dt.strftime('%d.%m.%y'),
+                                      dt.strftime('%H:%M:%S'),
+                                      hours, seconds // 60, seconds % 60)))
+            return result
+        elif command == 'PBRTR':
+            index = int(fields[1])
+            if 0 <= index < len(self.tracklogs):
+                return self.tracklog_content(index)
+            return []
+        elif command == 'PBRWPS' or command == 'PBRWPSE':
+            result = []
+            for w in self.waypoints:
+                sentence = 'PBRWPS,%s,%s,%s,%04d' \
+                           % (w.nmea(), w.short_name, w.long_name, max(0, w.ele))
+                if command == 'PBRWPSE':
+                    sentence += ',%03d' % w.type
+                result.append(nmea(sentence))
+            return result
+        elif command == 'PBRWPR' or command == 'PBRWPRE':
+            m = (PBRWPRE_RE if command == 'PBRWPRE' else PBRWPR_RE) \
+                .match(sentence)
+            if m:
+                w = pbrwps_waypoint(m)
+                w.long_name = '%s %s' % (m.group(9), m.group(10))
+                self.waypoints = [x for x in self.waypoints
+                                  if x.long_name != w.long_name]
+                if len(self.waypoints) < WAYPOINT_CAPACITY:
+                    self.waypoints.append(w)
+            return []
+        elif command == 'PBRWPX':
+            long_name = sentence[len('PBRWPX,'):].rstrip()
+            self.waypoints = [w for w in self.waypoints
+                              if w.long_name.rstrip() != long_name]
+            return []
+        elif command == 'PBRRTS':
+            result = []
+            for route in self.routes:
+                count = len(route.routepoints) + 1
+                result.append(nmea('PBRRTS,%02d,%02d,00,%s'
+                                   % (route.index, count, route.name)))
+                for i, rp in enumerate(route.routepoints):
+                    result.append(nmea('PBRRTS,%02d,%02d,%02d,%s,%s'
+                                       % (route.index, count, i + 1,
+                                          rp.short_name, rp.long_name)))
+            return result
+        elif command == 'PBRRTX':
+            name = sentence[len('PBRRTX,'):].rstrip()
+            self.routes = [r for r in self.routes if r.name.rstrip() != name]
+            return []
+        elif command == 'PBRMEMR':
+            address = int(fields[1], 16)
+            data = self.memory[address:address + 8]
+            return [nmea('PBRMEMR,%04X,%s'
+                         % (address, ','.join('%02X' % b for b in data)))]
+        elif command == 'PBRCONF' or command == 'PBRIGC':
+            return []
+        return None
+
+    def write(self, fd, data):
+        if not self.baud:
+            while data:
+                data = data[os.write(fd, data):]
+            return
+        chunk = max(1, self.baud // 1000)
+        deadline = time.time()
+        for offset in xrange(0, len(data), chunk):
+            n = os.write(fd, data[offset:offset + chunk])
+            while n < min(chunk, len(data) - offset):
+                n += os.write(fd, data[offset + n:offset + chunk])
+            deadline += 10.0 * n / self.baud
+            delay = deadline - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def serve(self, fd):
+        buffer = ''
+        while True:
+            try:
+                data = os.read(fd, 1024)
+            except OSError:
+                return
+            if not data:
+                return
+            buffer += data
+            lines = buffer.split('\n')
+            buffer = lines.pop()
+            for line in lines:
+                try:
+                    sentence = (line + '\n').decode('nmea_sentence')
+                except NMEAError:
+                    continue
+                with self.lock:
+                    response = self.respond(sentence)
+                if not response is None:
+                    self.write(fd, XOFF + ''.join(response) + XON)
+
+    def start(self):
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        self.slave = slave
+        self.thread = threading.Thread(target=self.serve, args=(master,))
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return os.ttyname(slave)
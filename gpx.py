@@ -17,89 +17,126 @@
 
 from __future__ import with_statement
 
-from contextlib import contextmanager
+import re
+import threading
 try:
-    from xml.etree.cElementTree import ElementTree, TreeBuilder, parse
+    from xml.etree.cElementTree import iterparse
 except ImportError:
-    from xml.etree.ElementTree import ElementTree, TreeBuilder, parse
-import re
+    from xml.etree.ElementTree import iterparse
+from xml.sax.saxutils import escape
 
 from flytecdevice import Waypoint
 
 
 TRAILING_ZEROS_RE = re.compile(r'\.0*\Z|0+\Z')
 
-
-@contextmanager
-def tag(tb, name, attrs={}):
-    tb.start(name, attrs)
-    yield tb
-    tb.end(name)
-
-
 GPX_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 
-
-@contextmanager
-def gpx_tag():
-    attrs = {
-        'creator': 'http://code.google.com/p/flytecfs',
-        'version': '1.1',
-        'xmlns': 'http://www.topografix.com/GPX/1/1',
-        'xmlns:xsi': 'http://www.w3.org/2001/XMLSchema-instance',
-        'xsi:schemaLocation': 'http://www.topografix.com/GPX/1/1 '
-                              'http://www.topografix.com/GPX/1/1/gpx.xsd',
-        }
-    with tag(TreeBuilder(), 'gpx', attrs) as tb:
-        yield tb
-
-
-@contextmanager
-def wptType_tag(tb, waypoint, name):
-    lat = TRAILING_ZEROS_RE.sub('', '%.5f' % (waypoint.lat / 60000.0))
-    lon = TRAILING_ZEROS_RE.sub('', '%.5f' % (waypoint.lon / 60000.0))
-    with tag(tb, name, {'lat': lat, 'lon': lon}):
-        with tag(tb, 'name'):
-            tb.data(waypoint.long_name.rstrip())
-        with tag(tb, 'ele'):
-            tb.data(str(waypoint.ele))
-
-
-@contextmanager
-def rte_tag(tb, route, waypoint_get):
-    with tag(tb, 'rte'):
-        with tag(tb, 'name'):
-            tb.data(route.name.rstrip())
-        for routepoint in route.routepoints:
-            waypoint = waypoint_get(routepoint.long_name)
-            wptType_tag(tb, waypoint, 'rtept')
-
-
-def write(tb, file, indent='\t'):
-    def helper(element, prefix=''):
-        attrs = ''.join(' %s="%s"' % pair for pair in element.attrib.items())
-        if element.getchildren():
-            file.write('%s<%s%s>\n' % (prefix, element.tag, attrs))
-            for child in element.getchildren():
-                helper(child, prefix + indent)
-            file.write('%s</%s>\n' % (prefix, element.tag))
-        elif element.text:
-            file.write('%s<%s%s>%s</%s>\n' %
-                       (prefix, element.tag, attrs, element.text, element.tag))
-        else:
-            file.write('%s<%s%s/>\n' % (prefix, element.tag, attrs))
-    helper(ElementTree(tb.close()).getroot())
+GPX_ATTRS = (
+    ('creator', 'http://code.google.com/p/flytecfs'),
+    ('version', '1.1'),
+    ('xmlns', 'http://www.topografix.com/GPX/1/1'),
+    ('xmlns:xsi', 'http://www.w3.org/2001/XMLSchema-instance'),
+    ('xsi:schemaLocation', 'http://www.topografix.com/GPX/1/1 '
+                           'http://www.topografix.com/GPX/1/1/gpx.xsd'),
+    )
+
+HEADER = '<?xml version="1.0" encoding="utf-8"?>\n<gpx%s>\n' \
+         % ''.join(' %s="%s"' % pair for pair in GPX_ATTRS)
+FOOTER = '</gpx>\n'
+
+
+def coordinate(value):
+    return TRAILING_ZEROS_RE.sub('', '%.5f' % (value / 60000.0))
+
+
+def wpt(waypoint, name='wpt', indent='\t'):
+    return '%s<%s lat="%s" lon="%s">\n' \
+           '%s\t<name>%s</name>\n' \
+           '%s\t<ele>%d</ele>\n' \
+           '%s</%s>\n' % (indent, name,
+                          coordinate(waypoint.lat), coordinate(waypoint.lon),
+                          indent, escape(waypoint.long_name.rstrip()),
+                          indent, waypoint.ele,
+                          indent, name)
+
+
+def rte(route, waypoint_get, rtept=None, indent='\t'):
+    if rtept is None:
+        rtept = lambda waypoint: wpt(waypoint, 'rtept', indent + '\t')
+    result = ['%s<rte>\n' % indent,
+              '%s\t<name>%s</name>\n' % (indent, escape(route.name.rstrip()))]
+    for routepoint in route.routepoints:
+        waypoint = waypoint_get(routepoint.long_name)
+        if not waypoint is None:
+            result.append(rtept(waypoint))
+    result.append('%s</rte>\n' % indent)
+    return ''.join(result)
+
+
+def trk(track, name, indent='\t'):
+    yield '%s<trk>\n' % indent
+    yield '%s\t<name>%s</name>\n' % (indent, escape(name))
+    yield '%s\t<trkseg>\n' % indent
+    for dt, lat, lon, ele in zip(track.datetimes(), track.lat.tolist(),
+                                 track.lon.tolist(), track.gnss_alt.tolist()):
+        yield '%s\t\t<trkpt lat="%s" lon="%s">' \
+              '<ele>%d</ele><time>%s</time></trkpt>\n' \
+              % (indent, coordinate(lat), coordinate(lon), ele,
+                 dt.strftime(GPX_DATETIME_FORMAT))
+    yield '%s\t</trkseg>\n' % indent
+    yield '%s</trk>\n' % indent
+
+
+class FragmentCache(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fragments = {}
+
+    def get(self, key, rev, render):
+        with self.lock:
+            entry = self.fragments.get(key)
+        if not entry is None and entry[0] == rev:
+            return entry[1]
+        fragment = render()
+        with self.lock:
+            self.fragments[key] = (rev, fragment)
+        return fragment
+
+    def prune(self, kind, names):
+        with self.lock:
+            for key in self.fragments.keys():
+                if key[0] == kind and not key[1] in names:
+                    del self.fragments[key]
+
+
+def waypoint(element, prefix=''):
+    lat = int(round(60000 * float(element.get('lat'))))
+    lon = int(round(60000 * float(element.get('lon'))))
+    ele_tag = element.find(prefix + 'ele')
+    ele = 0 if ele_tag is None else int(round(float(ele_tag.text)))
+    name_tag = element.find(prefix + 'name')
+    long_name = '' if name_tag is None else name_tag.text
+    short_name = '%-3s%03d' % (long_name[:3].upper(), (ele + 5) / 10)
+    return Waypoint(lat, lon, short_name, long_name, ele)
 
 
 def waypoints(file):
-    element = parse(file)
-    namespace = re.match('\{(.*)\}', element.getroot().tag).group(1)
-    for wpt in element.findall('/{%s}wpt' % namespace):
-        lat = int(round(60000 * float(wpt.get('lat'))))
-        lon = int(round(60000 * float(wpt.get('lon'))))
-        ele_tag = wpt.find('{%s}ele' % namespace)
-        ele = 0 if ele_tag is None else int(round(float(ele_tag.text)))
-        name_tag = wpt.find('{%s}name' % namespace)
-        long_name = '' if name_tag is None else name_tag.text
-        short_name = '%-3s%03d' % (long_name[:3].upper(), (ele + 5) / 10)
-        yield Waypoint(lat, lon, short_name, long_name, ele)
+    stack = []
+    prefix = ''
+    for event, element in iterparse(file, ('start', 'end')):
+        if event == 'start':
+            if not stack:
+                m = re.match(r'\{.*\}', element.tag)
+                if m:
+                    prefix = m.group(0)
+            stack.append(element)
+            continue
+        stack.pop()
+        if len(stack) == 1:
+            if element.tag == prefix + 'wpt':
+                yield waypoint(element, prefix)
+            del stack[0][-1]
+        elif len(stack) > 1 and stack[1].tag != prefix + 'wpt':
+            del stack[-1][-1]
@@ -0,0 +1,188 @@
+#   IGC functions
+#   Copyright (C) 2008  Tom Payne
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from array import array
+import datetime
+import re
+import struct
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+B_RECORD_RE = re.compile(r'^B(\d\d)(\d\d)(\d\d)'
+                         r'(\d\d)(\d{5})([NS])'
+                         r'(\d{3})(\d{5})([EW])'
+                         r'[AV](-\d{4}|\d{5})(-\d{4}|\d{5})', re.M)
+B_RECORD_LINE_RE = re.compile(r'^B[^\r\n]{34}', re.M)
+B_RECORD_LENGTH = 35
+B_RECORD_DIGITS = range(1, 14) + range(15, 23) + range(26, 30) \
+                  + range(31, 35)
+HFDTE_RE = re.compile(r'^HFDTE(?:DATE:)?(\d\d)(\d\d)(\d\d)', re.M)
+
+TRACK_MAGIC = 'IGCT\1'
+TRACK_HEADER = struct.Struct('<iI')
+
+
+def alt(value):
+    return -int(value[1:]) if value[0] == '-' else int(value)
+
+
+class Track(object):
+
+    def __init__(self, date, time, lat, lon, pressure_alt, gnss_alt):
+        self.date = date
+        self.time = time
+        self.lat = lat
+        self.lon = lon
+        self.pressure_alt = pressure_alt
+        self.gnss_alt = gnss_alt
+
+    def __len__(self):
+        return len(self.time)
+
+    def columns(self):
+        return (self.time, self.lat, self.lon, self.pressure_alt,
+                self.gnss_alt)
+
+    def datetimes(self):
+        midnight = datetime.datetime.combine(self.date, datetime.time())
+        for seconds in self.time.tolist():
+            yield midnight + datetime.timedelta(seconds=seconds)
+
+    def nbytes(self):
+        return 4 * len(self.columns()) * len(self)
+
+    def save(self, file):
+        ordinal = 0 if self.date is None else self.date.toordinal()
+        file.write(TRACK_MAGIC)
+        file.write(TRACK_HEADER.pack(ordinal, len(self)))
+        for column in self.columns():
+            if numpy is None:
+                column = array('i', column)
+                if sys.byteorder == 'big':
+                    column.byteswap()
+                file.write(column.tostring())
+            else:
+                file.write(numpy.asarray(column, '<i4').tostring())
+
+
+def load(file):
+    data = file.read()
+    if not data.startswith(TRACK_MAGIC):
+        raise ValueError
+    offset = len(TRACK_MAGIC)
+    ordinal, n = TRACK_HEADER.unpack_from(data, offset)
+    offset += TRACK_HEADER.size
+    if len(data) != offset + 4 * 5 * n:
+        raise ValueError
+    columns = []
+    for i in xrange(5):
+        if numpy is None:
+            column = array('i', data[offset:offset + 4 * n])
+            if sys.byteorder == 'big':
+                column.byteswap()
+        else:
+            column = numpy.frombuffer(data, '<i4', n, offset)
+        columns.append(column)
+        offset += 4 * n
+    date = datetime.date.fromordinal(ordinal) if ordinal else None
+    return Track(date, *columns)
+
+
+def date(content, default=None):
+    m = HFDTE_RE.search(content)
+    if m:
+        day, month, year = map(int, m.groups())
+        try:
+            return datetime.date(2000 + year if year < 80 else 1900 + year,
+                                 month, day)
+        except ValueError:
+            pass
+    return default
+
+
+def unwrap(time):
+    result = array('i')
+    offset = 0
+    previous = None
+    for seconds in time:
+        if not previous is None and seconds < previous:
+            offset += 86400
+        previous = seconds
+        result.append(seconds + offset)
+    return result
+
+
+def parse(content, default_date=None):
+    if numpy is None:
+        return _parse(content, default_date)
+    return _parse_numpy(content, default_date)
+
+
+def _parse(content, default_date):
+    time, lat, lon, pressure_alt, gnss_alt = \
+        array('i'), array('i'), array('i'), array('i'), array('i')
+    for m in B_RECORD_RE.finditer(content):
+        g = m.groups()
+        time.append(3600 * int(g[0]) + 60 * int(g[1]) + int(g[2]))
+        value = 60000 * int(g[3]) + int(g[4])
+        lat.append(-value if g[5] == 'S' else value)
+        value = 60000 * int(g[6]) + int(g[7])
+        lon.append(-value if g[8] == 'W' else value)
+        pressure_alt.append(alt(g[9]))
+        gnss_alt.append(alt(g[10]))
+    return Track(date(content, default_date), unwrap(time), lat, lon,
+                 pressure_alt, gnss_alt)
+
+
+def _parse_numpy(content, default_date):
+    records = B_RECORD_LINE_RE.findall(content)
+    if not records:
+        return _parse(content, default_date)
+    rows = numpy.frombuffer(''.join(records), numpy.uint8)
+    rows = rows.reshape(len(records), B_RECORD_LENGTH)
+    digits = rows.astype(numpy.int32) - ord('0')
+    valid = (digits[:, B_RECORD_DIGITS] <= 9).all(1)
+    valid &= (digits[:, B_RECORD_DIGITS] >= 0).all(1)
+    for column, chars in ((14, 'NS'), (23, 'EW'), (24, 'AV'),
+                          (25, '-0123456789'), (30, '-0123456789')):
+        valid &= numpy.in1d(rows[:, column], map(ord, chars))
+    digits = digits[valid]
+    rows = rows[valid]
+    def number(start, stop):
+        weights = 10 ** numpy.arange(stop - start - 1, -1, -1)
+        return numpy.dot(digits[:, start:stop], weights).astype(numpy.int32)
+    time = 3600 * number(1, 3) + 60 * number(3, 5) + number(5, 7)
+    if len(time):
+        wraps = numpy.concatenate(([0], numpy.diff(time) < 0))
+        time += 86400 * numpy.cumsum(wraps).astype(numpy.int32)
+    lat = 60000 * number(7, 9) + number(9, 14)
+    lat[rows[:, 14] == ord('S')] *= -1
+    lon = 60000 * number(15, 18) + number(18, 23)
+    lon[rows[:, 23] == ord('W')] *= -1
+    alts = []
+    for start in 25, 30:
+        negative = rows[:, start] == ord('-')
+        value = number(start + 1, start + 5)
+        value[~negative] += 10000 * digits[~negative, start]
+        value[negative] *= -1
+        alts.append(value)
+    return Track(date(content, default_date), time, lat, lon, *alts)
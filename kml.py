@@ -0,0 +1,39 @@
+#   KML functions
+#   Copyright (C) 2008  Tom Payne
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from xml.sax.saxutils import escape
+
+from gpx import coordinate
+
+
+HEADER = '<?xml version="1.0" encoding="utf-8"?>\n' \
+         '<kml xmlns="http://www.opengis.net/kml/2.2">\n'
+FOOTER = '</kml>\n'
+
+
+def placemark(track, name, indent='\t'):
+    yield '%s<Placemark>\n' % indent
+    yield '%s\t<name>%s</name>\n' % (indent, escape(name))
+    yield '%s\t<LineString>\n' % indent
+    yield '%s\t\t<altitudeMode>absolute</altitudeMode>\n' % indent
+    yield '%s\t\t<coordinates>\n' % indent
+    for lat, lon, ele in zip(track.lat.tolist(), track.lon.tolist(),
+                             track.gnss_alt.tolist()):
+        yield '%s,%s,%d\n' % (coordinate(lon), coordinate(lat), ele)
+    yield '%s\t\t</coordinates>\n' % indent
+    yield '%s\t</LineString>\n' % indent
+    yield '%s</Placemark>\n' % indent
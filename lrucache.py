@@ -0,0 +1,98 @@
+#   Size-bounded LRU cache
+#   Copyright (C) 2008  Tom Payne
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import with_statement
+
+import threading
+
+
+PREV, NEXT, KEY, VALUE, SIZE = range(5)
+
+
+class LRUCache(object):
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.links = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, 0]
+
+    def __contains__(self, key):
+        return key in self.links
+
+    def __len__(self):
+        return len(self.links)
+
+    def get(self, key, default=None):
+        with self.lock:
+            link = self.links.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._unlink(link)
+            self._link(link)
+            return link[VALUE]
+
+    def put(self, key, value, size):
+        with self.lock:
+            if key in self.links:
+                self._remove(self.links[key])
+            link = [None, None, key, value, size]
+            self._link(link)
+            self.links[key] = link
+            self.size += size
+            while self.size > self.budget and self.root[PREV] is not link:
+                self._remove(self.root[PREV])
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self.lock:
+            link = self.links.get(key)
+            if link is None:
+                return default
+            self._remove(link)
+            return link[VALUE]
+
+    def status(self):
+        lines = ['budget: %d' % self.budget,
+                 'size: %d' % self.size,
+                 'entries: %d' % len(self.links),
+                 'hits: %d' % self.hits,
+                 'misses: %d' % self.misses,
+                 'evictions: %d' % self.evictions]
+        return ''.join('%s\n' % line for line in lines)
+
+    def _link(self, link):
+        link[PREV] = self.root
+        link[NEXT] = self.root[NEXT]
+        self.root[NEXT][PREV] = link
+        self.root[NEXT] = link
+
+    def _remove(self, link):
+        self._unlink(link)
+        del self.links[link[KEY]]
+        self.size -= link[SIZE]
+
+    def _unlink(self, link):
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
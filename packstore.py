@@ -0,0 +1,267 @@
+#   Append-only pack store
+#   Copyright (C) 2008  Tom Payne
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import with_statement
+
+from contextlib import contextmanager
+import fcntl
+from mmap import mmap, ACCESS_READ, ALLOCATIONGRANULARITY
+import os
+import os.path
+import threading
+import zlib
+
+
+class Entry(object):
+
+    def __init__(self, id, offset, length, crc, deflate_offset,
+                 deflate_length, filename):
+        self.id = id
+        self.offset = offset
+        self.length = length
+        self.crc = crc
+        self.deflate_offset = deflate_offset
+        self.deflate_length = deflate_length
+        self.filename = filename
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.__dict__)
+
+    def record(self):
+        return '+ %s %d %d %08x %d %d %s\n' % (self.id,
+                                              self.offset,
+                                              self.length,
+                                              self.crc,
+                                              self.deflate_offset,
+                                              self.deflate_length,
+                                              self.filename)
+
+
+def align(offset):
+    return -(-offset // ALLOCATIONGRANULARITY) * ALLOCATIONGRANULARITY
+
+
+def deflate(content):
+    compressobj = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressobj.compress(content) + compressobj.flush()
+
+
+class PackStore(object):
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.lock = threading.RLock()
+        self.index_path = os.path.join(dirname, 'pack.index')
+        self.lock_path = os.path.join(dirname, 'pack.lock')
+        self.entries = {}
+        self.generation = 0
+        self.index_ino = None
+        self.pack_fd = None
+        self.load()
+
+    def __contains__(self, id):
+        return id in self.entries
+
+    def __iter__(self):
+        return iter(self.entries.values())
+
+    def get(self, id):
+        return self.entries.get(id)
+
+    def pack_path(self, generation=None):
+        if generation is None:
+            generation = self.generation
+        return os.path.join(self.dirname, 'pack-%d' % generation)
+
+    def load(self):
+        with self.lock:
+            entries = {}
+            generation, index_ino, data = 0, None, ''
+            try:
+                with open(self.index_path) as file:
+                    index_ino = os.fstat(file.fileno()).st_ino
+                    data = file.read()
+            except IOError:
+                pass
+            lines = data.split('\n')[:-1]
+            if lines and lines[0].startswith('pack '):
+                generation = int(lines.pop(0).split()[1])
+            for line in lines:
+                fields = line.split(' ', 7)
+                try:
+                    if fields[0] == '+':
+                        entry = Entry(fields[1],
+                                      int(fields[2]),
+                                      int(fields[3]),
+                                      int(fields[4], 16),
+                                      int(fields[5]),
+                                      int(fields[6]),
+                                      fields[7])
+                        entries[entry.id] = entry
+                    elif fields[0] == '-':
+                        entries.pop(fields[1], None)
+                except (IndexError, ValueError):
+                    pass
+            if not self.pack_fd is None:
+                os.close(self.pack_fd)
+                self.pack_fd = None
+            try:
+                self.pack_fd = os.open(self.pack_path(generation), os.O_RDONLY)
+                size = os.fstat(self.pack_fd).st_size
+            except OSError:
+                size = 0
+            self.entries = dict((id, entry)
+                                for id, entry in entries.items()
+                                if entry.offset + entry.length <= size
+                                and entry.deflate_offset
+                                    + entry.deflate_length <= size)
+            self.generation = generation
+            self.index_ino = index_ino
+
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            if not os.path.exists(self.dirname):
+                os.makedirs(self.dirname)
+            with open(self.lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    try:
+                        index_ino = os.stat(self.index_path).st_ino
+                    except OSError:
+                        index_ino = None
+                    if index_ino != self.index_ino:
+                        self.load()
+                    yield
+                finally:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def append_records(self, records):
+        if self.index_ino is None:
+            records = ['pack %d\n' % self.generation] + records
+        with open(self.index_path, 'a+') as file:
+            file.seek(0, os.SEEK_END)
+            if file.tell():
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != '\n':
+                    file.seek(0)
+                    file.truncate(file.read().rfind('\n') + 1)
+            file.seek(0, os.SEEK_END)
+            file.write(''.join(records))
+            file.flush()
+            os.fsync(file.fileno())
+            self.index_ino = os.fstat(file.fileno()).st_ino
+
+    def append(self, id, content, filename):
+        deflated = deflate(content)
+        with self.locked():
+            fd = os.open(self.pack_path(), os.O_WRONLY | os.O_CREAT, 0644)
+            try:
+                offset = align(os.fstat(fd).st_size)
+                os.lseek(fd, offset, os.SEEK_SET)
+                os.write(fd, content)
+                os.write(fd, deflated)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            entry = Entry(id,
+                          offset,
+                          len(content),
+                          zlib.crc32(content) & 0xffffffff,
+                          offset + len(content),
+                          len(deflated),
+                          filename)
+            self.append_records([entry.record()])
+            self.entries[id] = entry
+            if self.pack_fd is None:
+                self.pack_fd = os.open(self.pack_path(), os.O_RDONLY)
+        return entry
+
+    def remove(self, id):
+        with self.locked():
+            if id in self.entries:
+                self.append_records(['- %s\n' % id])
+                del self.entries[id]
+
+    def rename(self, id, filename):
+        with self.locked():
+            if id in self.entries:
+                entry = self.entries[id]
+                entry.filename = filename
+                self.append_records([entry.record()])
+
+    def mmap(self, entry):
+        if not entry.length:
+            return ''
+        with self.lock:
+            return mmap(self.pack_fd, entry.length,
+                        access=ACCESS_READ, offset=entry.offset)
+
+    def read(self, offset, size):
+        with self.lock:
+            os.lseek(self.pack_fd, offset, os.SEEK_SET)
+            return os.read(self.pack_fd, size)
+
+    def read_deflated(self, id, size, offset):
+        with self.lock:
+            entry = self.entries[id]
+            size = min(size, entry.deflate_length - offset)
+            if size <= 0:
+                return ''
+            return self.read(entry.deflate_offset + offset, size)
+
+    def compact(self):
+        with self.locked():
+            generation = self.generation + 1
+            entries = {}
+            records = ['pack %d\n' % generation]
+            fd = os.open(self.pack_path(generation),
+                         os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0644)
+            try:
+                offset = 0
+                for id in sorted(self.entries.keys()):
+                    old = self.entries[id]
+                    offset = align(offset)
+                    os.lseek(fd, offset, os.SEEK_SET)
+                    os.write(fd, self.read(old.offset, old.length))
+                    os.write(fd, self.read(old.deflate_offset,
+                                           old.deflate_length))
+                    entry = Entry(id,
+                                  offset,
+                                  old.length,
+                                  old.crc,
+                                  offset + old.length,
+                                  old.deflate_length,
+                                  old.filename)
+                    entries[id] = entry
+                    records.append(entry.record())
+                    offset += old.length + old.deflate_length
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'w') as file:
+                file.write(''.join(records))
+                file.flush()
+                os.fsync(file.fileno())
+            os.rename(tmp_path, self.index_path)
+            old_pack_path = self.pack_path()
+            self.load()
+            if os.path.exists(old_pack_path):
+                os.unlink(old_pack_path)
+            return entries
@@ -0,0 +1,115 @@
+#   Statistics
+#   Copyright (C) 2008  Tom Payne
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import with_statement
+
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import time
+
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def labels_string(labels, *extra):
+    labels = tuple(labels) + extra
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value)
+                                                .replace('\\', '\\\\')
+                                                .replace('"', '\\"'))
+                             for key, value in labels)
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        result = []
+        total = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), self.counts):
+            total += count
+            result.append('%s_bucket%s %d' % (name,
+                                              labels_string(labels,
+                                                            ('le', bound)),
+                                              total))
+        result.append('%s_sum%s %.6f' % (name, labels_string(labels),
+                                         self.sum))
+        result.append('%s_count%s %d' % (name, labels_string(labels),
+                                         self.count))
+        return result
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.types = {}
+        self.values = {}
+
+    def count(self, name, labels=(), n=1):
+        with self.lock:
+            self.types.setdefault(name, 'counter')
+            key = (name, tuple(labels))
+            self.values[key] = self.values.get(key, 0) + n
+
+    def set(self, name, labels=(), value=0, type='gauge'):
+        with self.lock:
+            self.types.setdefault(name, type)
+            self.values[(name, tuple(labels))] = value
+
+    def observe(self, name, labels=(), value=0.0):
+        with self.lock:
+            self.types.setdefault(name, 'histogram')
+            key = (name, tuple(labels))
+            if not key in self.values:
+                self.values[key] = Histogram()
+            self.values[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, labels=()):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, labels, time.time() - start)
+
+    def status(self):
+        lines = []
+        with self.lock:
+            for name in sorted(self.types.keys()):
+                lines.append('# TYPE %s %s' % (name, self.types[name]))
+                for key in sorted(k for k in self.values.keys()
+                                  if k[0] == name):
+                    value = self.values[key]
+                    if isinstance(value, Histogram):
+                        lines.extend(value.lines(name, key[1]))
+                    else:
+                        lines.append('%s%s %s' % (name, labels_string(key[1]),
+                                                  value))
+        return ''.join('%s\n' % line for line in lines)
@@ -0,0 +1,118 @@
+#   Virtual ZIP archives
+#   Copyright (C) 2008  Tom Payne
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from bisect import bisect_right
+import struct
+
+
+LOCAL_FILE_HEADER_FORMAT = '<4s2B4HL2L2H'
+CENTRAL_DIRECTORY_FORMAT = '<4s4B4HL2L5H2L'
+END_OF_CENTRAL_DIRECTORY_FORMAT = '<4s4H2LH'
+LOCAL_FILE_HEADER_SIZE = struct.calcsize(LOCAL_FILE_HEADER_FORMAT)
+CENTRAL_DIRECTORY_SIZE = struct.calcsize(CENTRAL_DIRECTORY_FORMAT)
+END_OF_CENTRAL_DIRECTORY_SIZE = \
+    struct.calcsize(END_OF_CENTRAL_DIRECTORY_FORMAT)
+
+ZIP_DEFLATED = 8
+ZIP_VERSION = 20
+
+
+class Member(object):
+
+    def __init__(self, filename, date_time, crc, compress_size, file_size,
+                 reader, external_attr=0):
+        self.filename = filename
+        self.date_time = date_time
+        self.crc = crc
+        self.compress_size = compress_size
+        self.file_size = file_size
+        self.reader = reader
+        self.external_attr = external_attr
+
+    def dos_date_time(self):
+        year, month, day, hour, minute, second = self.date_time[:6]
+        date = (year - 1980) << 9 | month << 5 | day
+        time = hour << 11 | minute << 5 | second // 2
+        return date, time
+
+
+class VirtualZipFile(object):
+
+    def __init__(self, members):
+        self.offsets = []
+        self.segments = []
+        self.size = 0
+        central_directory = []
+        for member in members:
+            date, time = member.dos_date_time()
+            header = struct.pack(LOCAL_FILE_HEADER_FORMAT, 'PK\003\004',
+                                 ZIP_VERSION, 0, 0, ZIP_DEFLATED, time, date,
+                                 member.crc, member.compress_size,
+                                 member.file_size, len(member.filename), 0)
+            central_directory.append(struct.pack(CENTRAL_DIRECTORY_FORMAT,
+                                                 'PK\001\002',
+                                                 ZIP_VERSION, 3,
+                                                 ZIP_VERSION, 0,
+                                                 0, ZIP_DEFLATED, time, date,
+                                                 member.crc,
+                                                 member.compress_size,
+                                                 member.file_size,
+                                                 len(member.filename),
+                                                 0, 0, 0, 0,
+                                                 member.external_attr,
+                                                 self.size))
+            central_directory.append(member.filename)
+            self.append_string(header + member.filename)
+            self.append(member.compress_size, member.reader)
+        central_directory = ''.join(central_directory)
+        end = struct.pack(END_OF_CENTRAL_DIRECTORY_FORMAT, 'PK\005\006',
+                          0, 0, len(members), len(members),
+                          len(central_directory), self.size, 0)
+        self.append_string(central_directory + end)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, sl):
+        start, stop, stride = sl.indices(self.size)
+        return self.read(stop - start, start)
+
+    def append(self, length, reader):
+        if length:
+            self.offsets.append(self.size)
+            self.segments.append((length, reader))
+            self.size += length
+
+    def append_string(self, string):
+        def reader(size, offset):
+            return string[offset:offset + size]
+        self.append(len(string), reader)
+
+    def read(self, size, offset):
+        if offset >= self.size:
+            return ''
+        result = []
+        index = bisect_right(self.offsets, offset) - 1
+        while size > 0 and 0 <= index < len(self.segments):
+            length, reader = self.segments[index]
+            segment_offset = offset - self.offsets[index]
+            n = min(size, length - segment_offset)
+            result.append(reader(n, segment_offset))
+            offset += n
+            size -= n
+            index += 1
+        return ''.join(result)